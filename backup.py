@@ -1,25 +1,125 @@
 from argparse import ArgumentParser
+import cProfile
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import ctypes
+import ctypes.util
 import datetime
+import errno
+import gzip
 import hashlib
+import heapq
+from itertools import groupby
+import json
 import logging
+import multiprocessing
 import os
+import platform
 import re
-from shutil import copy2 as copy, rmtree, make_archive
+import select
+import signal
+import sqlite3
+import stat
+from shutil import copy2 as copy, copyfileobj, copystat, rmtree
+import struct
 import sys
+from tempfile import SpooledTemporaryFile
+import threading
+import time
 import toml
-from zipfile import ZipFile
+# _get_compressor builds the same compressor objects ZipFile uses, so pre-compressed entries read back like any other
+from zipfile import ZIP64_LIMIT, ZIP_BZIP2, ZIP_DEFLATED, ZIP_LZMA, ZIP_STORED, ZipFile, ZipInfo, _get_compressor
+import zlib
 
 conf = None
 logger = None
+ignore_matcher = None
 
 conf_path: str = "./conf.toml"
 records_path: str = "./records.toml"
+records_db_path: str = "./records.db"
+records_head_path: str = "./records-head.toml"
+records_head_db_path: str = "./records-head.db"
+journal_path: str = "./journal.db"
 stats_path: str = "./stats.toml"
 tmp_log_path: str = "/tmp/python-backup.log"
+# --watch runs alongside backups, which would otherwise log into its file and delete it when they finish
+watch_log_path: str = "/tmp/python-backup-watch.log"
+
+# 2 is stored in stats as last_backup_type before any backup has run
+backup_types: dict = {0: "Full", 1: "Differential", 3: "Incremental"}
+
+backup_name_pattern: str = r"^(Full|Differential|Incremental)_(\d{2}-\d{2}-\d{4}_(Mon|Tue|Wed|Thu|Fri|Sat|Sun)_\d{2}-\d{2}-\d{2})$"
+
+hash_algorithms: tuple = ("mtime", "md5", "sha256", "blake2b")
+hash_chunk_size: int = 1024 * 1024
+hash_buffer = threading.local()
+restore_handles = threading.local()
+# most steps of the walk (runs of files, and entering or leaving a directory) held between looking files up and copying them,
+# so the hash pool can work on the files of later directories
+walk_lookahead: int = 1024
+
+compression_methods: dict = {"deflate": ZIP_DEFLATED, "bzip2": ZIP_BZIP2, "lzma": ZIP_LZMA, "store": ZIP_STORED}
+default_store_extensions: list = [
+    ".7z", ".aac", ".avi", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic", ".jar", ".jpeg", ".jpg", ".m4a", ".mkv",
+    ".mov", ".mp3", ".mp4", ".ogg", ".png", ".pptx", ".rar", ".tgz", ".webm", ".webp", ".xlsx", ".xz", ".zip", ".zst",
+]
+# files whose first block shrinks by less than this are stored instead of compressed
+compression_sample_size: int = 64 * 1024
+compression_min_saving: float = 0.05
+# files up to this size are compressed on the compression threads and held in memory until they're written; larger ones are
+# compressed straight into the archive by the writer, so neither memory nor the temporary directory ever holds a whole large file
+compression_spool_size: int = 8 * 1024 * 1024
+
+# inotify(7) flags used by the change journal watcher
+IN_MODIFY: int = 0x2
+IN_ATTRIB: int = 0x4
+IN_CLOSE_WRITE: int = 0x8
+IN_MOVED_FROM: int = 0x40
+IN_MOVED_TO: int = 0x80
+IN_CREATE: int = 0x100
+IN_DELETE: int = 0x200
+IN_Q_OVERFLOW: int = 0x4000
+IN_IGNORED: int = 0x8000
+IN_ONLYDIR: int = 0x1000000
+IN_EXCL_UNLINK: int = 0x4000000
+IN_ISDIR: int = 0x40000000
+IN_CLOEXEC: int = 0x80000
+watch_mask: int = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_EXCL_UNLINK
+# how long a backup waits for the watcher to confirm its journal is up to date
+journal_sync_timeout: float = 10.0
+# the checkpoint is also written out this often, so a run interrupted before a full batch of records still has something to resume from
+checkpoint_interval: float = 2.0
+
+# content-defined chunking for the repository: every byte maps to one bit, and a chunk ends after the bits of the last
+# 19 bytes spell out chunk_anchor, so inserting or removing data only moves the boundaries around the edit.
+# translate and find run in C; a per-byte rolling hash in Python manages only a few MB/s.
+chunk_min_size: int = 256 * 1024
+chunk_max_size: int = 4 * 1024 * 1024
+chunk_anchor: bytes = b"1011001110001011010"
+# derived from blake2b rather than random so it never changes between Python versions; changing it would stop all dedup
+chunk_classes: bytes = bytes(ord("0") + (hashlib.blake2b(bytes([i]), digest_size=1).digest()[0] & 1) for i in range(0, 256))
+
+# large files that changed since the last full backup can be stored as the blocks that differ from the full's copy.
+# A delta is this line, a line of JSON saying where each run of the file comes from, and then the changed data
+delta_magic: bytes = b"backup.py delta 1\n"
+# a file with more than this fraction changed is stored whole, since restoring a delta also reads the full's copy
+delta_max_changed: float = 0.5
+
+# ioprio_set has no libc wrapper, so it's called by its syscall number
+ioprio_syscalls: dict = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "riscv64": 30, "armv7l": 314, "ppc64le": 273, "s390x": 282}
+IOPRIO_WHO_PROCESS: int = 1
+IOPRIO_CLASS_SHIFT: int = 13
+IOPRIO_CLASS_BE: int = 2
+IOPRIO_CLASS_IDLE: int = 3
+
+Entry = namedtuple("Entry", ["path", "name", "rel", "is_dir", "stat"])
 
 init_time: str = datetime.datetime.now().strftime("%m-%d-%Y_%a_%H-%M-%S")
 log_dir: str = "./logs/"
 log_destination: str = log_dir + init_time + ".log"
+# the same log in the other destinations a backup was written to
+log_copies: list = []
 
 def init_logger():
     console = logging.StreamHandler(sys.stdout)
@@ -38,8 +138,90 @@ def init_logger():
 
 def write_log():
     copy(tmp_log_path, log_destination)
+    for path in log_copies:
+        try:
+            copy(tmp_log_path, path)
+        except OSError as e:
+            print("Could not write the log to %s: %s" %(path, str(e)))
     os.remove(tmp_log_path)
 
+class Metrics:
+    slowest_kept: int = 20
+
+    def __init__(self):
+        self.lock: threading.Lock = threading.Lock()
+        self.started: float = time.time()
+        # phase -> [seconds, files, bytes]
+        self.phases: dict = {}
+        self.counters: dict = {}
+        self.slowest: list = []
+
+    def add(self, phase: str, seconds: float, files: int=0, size: int=0):
+        with self.lock:
+            totals: list = self.phases.setdefault(phase, [0.0, 0, 0])
+            totals[0] += seconds
+            totals[1] += files
+            totals[2] += size
+
+    def count(self, counter: str, amount: int=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def file_time(self, path: str, seconds: float, size: int):
+        # a min-heap of the slowest files seen so far
+        with self.lock:
+            if len(self.slowest) < self.slowest_kept:
+                heapq.heappush(self.slowest, (seconds, path, size))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, path, size))
+
+    def report(self, backup_record: dict):
+        report: dict = {
+            "name": backup_record["name"],
+            "type": backup_record["type"],
+            "started": self.started,
+            "duration_seconds": round(time.time() - self.started, 6),
+            "total_files": backup_record["total_files"],
+            "total_directories": backup_record["total_directories"],
+            "total_filesize": backup_record["total_filesize"],
+            "destinations": backup_record["paths"],
+            "failed_destinations": backup_record["failed"],
+            "phases": {phase: {"seconds": round(totals[0], 6), "files": totals[1], "bytes": totals[2]} for phase, totals in sorted(self.phases.items())},
+            "counters": dict(sorted(self.counters.items())),
+            "slowest_files": [{"path": path, "seconds": round(seconds, 6), "bytes": size} for seconds, path, size in sorted(self.slowest, reverse=True)],
+        }
+        return report
+
+    def write_json(self, report: dict, path: str):
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    def write_prometheus(self, report: dict, path: str):
+        lines: list = []
+        def metric(name: str, kind: str, help_text: str, samples: list):
+            lines.append("# HELP %s %s" %(name, help_text))
+            lines.append("# TYPE %s %s" %(name, kind))
+            for labels, value in samples:
+                label_text: str = ",".join('%s="%s"' %(key, str(label).replace("\\", "\\\\").replace('"', '\\"')) for key, label in labels.items())
+                lines.append("%s{%s} %s" %(name, label_text, repr(value)) if label_text != "" else "%s %s" %(name, repr(value)))
+
+        metric("backup_last_run_timestamp_seconds", "gauge", "When the last backup started.", [({"type": report["type"]}, report["started"])])
+        metric("backup_last_run_duration_seconds", "gauge", "How long the last backup took.", [({"type": report["type"]}, report["duration_seconds"])])
+        metric("backup_last_run_files", "gauge", "Files written by the last backup.", [({"type": report["type"]}, report["total_files"])])
+        metric("backup_last_run_bytes", "gauge", "Uncompressed bytes written by the last backup.", [({"type": report["type"]}, report["total_filesize"])])
+        metric("backup_phase_seconds", "gauge", "Time spent in each phase of the last backup.", [({"phase": phase}, totals["seconds"]) for phase, totals in report["phases"].items()])
+        metric("backup_phase_files", "gauge", "Files handled in each phase of the last backup.", [({"phase": phase}, totals["files"]) for phase, totals in report["phases"].items()])
+        metric("backup_phase_bytes", "gauge", "Bytes handled in each phase of the last backup.", [({"phase": phase}, totals["bytes"]) for phase, totals in report["phases"].items()])
+        metric("backup_items", "gauge", "Items seen by the last backup, by outcome.", [({"outcome": counter}, value) for counter, value in report["counters"].items()])
+        metric("backup_last_run_failed_destinations", "gauge", "Destinations the last backup could not be completed in.", [({"type": report["type"]}, len(report["failed_destinations"]))])
+
+        # the textfile collector may read at any moment, so never leave a half written file
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+metrics: Metrics = Metrics()
+
 def gen_config_file(path: str):
     if os.path.exists(path):
         return
@@ -52,10 +234,14 @@ source-directories = [
 
 ]
 
-# Add destination at which to store backups
+# Add destination at which to store backups. A list of destinations, e.g. a local disk and a network mount, gets a copy of every backup in each,
+# reading every source file once. Each destination keeps its own catalog and retention, and one failing doesn't stop the others.
+# The first destination is the one listings, restores and --resume use.
 destination = ""
 
 # Regular expressions to test items against. If a match occurs, the file will be ignored. Remember to properly escape special characters.
+# Patterns without a "/" are matched against the item's name; patterns containing a "/" are matched against its path relative to the source directory, e.g. "web/node_modules$".
+# Ignored directories are skipped entirely.
 ignored = [
 
 ]
@@ -63,14 +249,104 @@ ignored = [
 # Set total number of differential backups to perform before the next full backup
 differential-backups = 6
 
+# Run incremental backups instead of differentials between full backups. An incremental only stores what changed since the previous backup of any kind,
+# but restoring it needs every backup back to the last full. differential-backups still sets how many run before the next full backup.
+incremental-backups = false
+
 # Number of full backups to keep
 keep-full-backups = 3
 
 # Number of differential backups to keep
 keep-differential-backups = 7
 
-# Use MD5 hashing instead of mtime to check if a file has been changed. MD5 is more accurate, but heavily increases the amount of time that the backup takes.
-use-md5 = false"""
+# Number of incremental backups to keep. Older backups that a kept incremental builds on are kept as well.
+keep-incremental-backups = 7
+
+# How to check if a file has been changed: "mtime", or a content hash ("blake2b", "sha256" or "md5").
+# Hashing is more accurate, but reads every file, which increases the amount of time that the backup takes. blake2b is the fastest of the hashes.
+hash-algorithm = "mtime"
+
+# Number of processes to hash files with. 0 uses one per CPU core.
+hash-workers = 0
+
+# Where to keep file records: "sqlite" (records.db, indexed, suited to large trees) or "toml" (records.toml, fine for small installs).
+# Switching to sqlite migrates an existing records.toml automatically.
+records-backend = "sqlite"
+
+# Number of files to copy concurrently. Values above 1 help on fast or network-mounted storage.
+workers = 1
+
+# With --no-compress, hardlink files that are unchanged since the last full backup instead of copying them, so every backup folder is a complete snapshot.
+# The destination must be on a filesystem that supports hardlinks.
+hardlink-snapshots = false
+
+# How zip backups compress files: "deflate", "bzip2", "lzma" or "store" (no compression).
+compression = "deflate"
+
+# Compression level from 1 (fastest) to 9 (smallest). lzma doesn't use it.
+compression-level = 6
+
+# Number of threads compressing files into the zip at once. 0 uses one per CPU core.
+compression-workers = 0
+
+# Files with these extensions are already compressed, so they're stored in the zip as they are instead of being compressed again.
+store-extensions = [
+    ".7z", ".aac", ".avi", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic", ".jar", ".jpeg", ".jpg", ".m4a", ".mkv",
+    ".mov", ".mp3", ".mp4", ".ogg", ".png", ".pptx", ".rar", ".tgz", ".webm", ".webp", ".xlsx", ".xz", ".zip", ".zst",
+]
+
+# Store backups in a repository instead of zips or folders: files are cut into chunks that are kept once in a chunks folder next to the
+# backups, however many files and backups contain them, and each backup only writes an index of its files' chunks. Every backup is then
+# complete on its own and unchanged files cost nothing to back up again. Chunks are compressed at compression-level unless compression is
+# "store" or the file's extension is in store-extensions. Chunks no backup uses any more are removed along with old backups.
+repository = false
+
+# Let differentials and incrementals back up only the paths that backup.py --watch saw change, instead of walking every source directory.
+# The watcher must be running from the same working directory as the backups, since both use journal.db there. A source the journal
+# hasn't covered without gaps since the last backup is walked as usual. Linux only; doesn't apply to repository backups or hardlink snapshots.
+journal = false
+
+# Path to write run metrics to in the Prometheus text format, e.g. the directory read by node_exporter's textfile collector
+# ("/var/lib/node_exporter/backup.prom"). Leave empty to only write metrics.json into each backup folder.
+metrics-textfile = ""
+
+# Limit on the combined rate at which the backup reads and writes files, in MB/s. 0 means no limit.
+bandwidth-limit = 0
+
+# Limit on the number of reads and writes per second; each moves at most 1MiB. 0 means no limit.
+iops-limit = 0
+
+# Run at nice 19 and in the idle I/O scheduling class, so the backup only gets the disks when nothing else wants them. Linux only.
+low-priority = false
+
+# Files of at least this many MB that changed since the last full backup are stored in differentials and incrementals as only the blocks
+# that differ from the full backup's copy. Suited to large files that change in place or grow, like databases, disk images and mailboxes.
+# Full backups record the checksums of each block of these files. Doesn't apply to repository backups or hardlink snapshots. 0 turns it off.
+delta-min-size = 0
+
+# Size of the blocks compared for delta-min-size, in KB. Smaller blocks store less of a changed file but keep more checksums.
+delta-block-size = 256
+
+# Read every file of a new backup back after it's written and check it against the sizes and hashes taken from the source.
+# Retention is skipped when anything fails to verify, so older backups are kept until a good one replaces them.
+verify-after-backup = false
+
+# Number of files checked concurrently by verification. 0 means one per CPU.
+verify-workers = 0
+
+# Settings for single source directories, keyed by their entry in source-directories. bandwidth-limit and iops-limit apply on top of the overall
+# limits while the directory's files are copied or archived; workers caps how many of its files are copied or compressed at once, up to
+# workers or compression-workers; low-priority puts only this directory in the idle I/O class.
+# [source-options."/var/lib/postgresql"]
+# workers = 1
+# bandwidth-limit = 20
+# iops-limit = 200
+# low-priority = true
+
+# Retention for single destinations, keyed by their entry in destination. Any of the keep-* settings can be set here.
+# [destination-options."/mnt/nfs/backups/"]
+# keep-full-backups = 6
+"""
 
     with open(path, "w") as f:
         f.write(conf_file)
@@ -84,14 +360,24 @@ def verify_conf(conf: dict):
     if "source-directories" not in keys or not isinstance(conf["source-directories"], list) or len(conf["source-directories"]) == 0:
         logger.critical("Invalid source-directories entry in " + conf_path)
         valid = False
-    if "destination" not in keys or len(conf["destination"]) == 0:
+    if "destination" not in keys or len(conf["destination"]) == 0 or (isinstance(conf["destination"], list) and not all(isinstance(destination, str) and len(destination) > 0 for destination in conf["destination"])):
         logger.critical("Invalid destination entry in " + conf_path)
         valid = False
-    elif conf["destination"][-1] != "/":
-        conf["destination"] += "/"
+    else:
+        # every destination gets the same backups; the first one is where restores, listings and checkpoints look first
+        destinations: list = conf["destination"] if isinstance(conf["destination"], list) else [conf["destination"]]
+        conf["destinations"] = [destination if destination[-1] == "/" else destination + "/" for destination in destinations]
+        conf["destination"] = conf["destinations"][0]
     if "ignored" not in keys or not isinstance(conf["ignored"], list):
         logger.critical("Invalid ignored entry in " + conf_path)
         valid = False
+    else:
+        for pattern in conf["ignored"]:
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                logger.critical("Invalid pattern %s in ignored entry in %s: %s" %(pattern, conf_path, str(e)))
+                valid = False
     if "differential-backups" not in keys or conf["differential-backups"] < 0:
         logger.critical("Invalid differential-backups entry in " + conf_path)
         valid = False
@@ -101,21 +387,171 @@ def verify_conf(conf: dict):
     if "keep-differential-backups" not in keys or conf["keep-differential-backups"] < 0:
         logger.critical("Invalid keep-differential-backups entry in " + conf_path)
         valid = False
-    if "use-md5" not in keys:
-        logger.critical("use-md5 key missing from config")
+    if "incremental-backups" not in keys:
+        conf["incremental-backups"] = False
+    elif not isinstance(conf["incremental-backups"], bool):
+        logger.critical("Invalid incremental-backups entry in " + conf_path)
+        valid = False
+    if "keep-incremental-backups" not in keys:
+        conf["keep-incremental-backups"] = 7
+    elif not isinstance(conf["keep-incremental-backups"], int) or conf["keep-incremental-backups"] < 0:
+        logger.critical("Invalid keep-incremental-backups entry in " + conf_path)
+        valid = False
+    if "hash-algorithm" not in keys:
+        # older configs only have the use-md5 switch
+        if "use-md5" not in keys:
+            logger.critical("hash-algorithm key missing from config")
+            valid = False
+        else:
+            conf["hash-algorithm"] = "md5" if conf["use-md5"] else "mtime"
+    elif conf["hash-algorithm"] not in hash_algorithms:
+        logger.critical("Invalid hash-algorithm entry in %s, must be one of %s" %(conf_path, ", ".join(hash_algorithms)))
+        valid = False
+    if "records-backend" not in keys:
+        # configs written before the sqlite backend existed keep their records.toml
+        conf["records-backend"] = "toml"
+    elif conf["records-backend"] not in ("toml", "sqlite"):
+        logger.critical("Invalid records-backend entry in %s, must be toml or sqlite" %conf_path)
+        valid = False
+    if conf.get("hash-algorithm") in hash_algorithms:
+        upgrade_toml_records(records_path, conf["hash-algorithm"])
+    if conf.get("hash-algorithm") in hash_algorithms and conf["records-backend"] in ("toml", "sqlite") and records_exist(conf):
+        records = open_records(conf, peek=True)
+        algorithm: str = records.algorithm
+        records.close()
+        if algorithm is None:
+            logger.critical("Record file at %s does not say which hash algorithm it stores. Remove it and run a full backup" %records.path)
+            valid = False
+        elif algorithm != conf["hash-algorithm"]:
+            logger.critical("config says to use %s, but record file is storing %s" %(conf["hash-algorithm"], algorithm))
+            valid = False
+    if "hash-workers" not in keys:
+        conf["hash-workers"] = 0
+    elif not isinstance(conf["hash-workers"], int) or conf["hash-workers"] < 0:
+        logger.critical("Invalid hash-workers entry in " + conf_path)
+        valid = False
+    if "hardlink-snapshots" not in keys:
+        conf["hardlink-snapshots"] = False
+    elif not isinstance(conf["hardlink-snapshots"], bool):
+        logger.critical("Invalid hardlink-snapshots entry in " + conf_path)
+        valid = False
+    if "workers" not in keys:
+        conf["workers"] = 1
+    elif not isinstance(conf["workers"], int) or conf["workers"] < 1:
+        logger.critical("Invalid workers entry in " + conf_path)
+        valid = False
+    if "metrics-textfile" not in keys:
+        conf["metrics-textfile"] = ""
+    elif not isinstance(conf["metrics-textfile"], str):
+        logger.critical("Invalid metrics-textfile entry in " + conf_path)
+        valid = False
+    if "compression" not in keys:
+        conf["compression"] = "deflate"
+    elif conf["compression"] not in compression_methods.keys():
+        logger.critical("Invalid compression entry in %s, must be one of %s" %(conf_path, ", ".join(compression_methods.keys())))
+        valid = False
+    if "compression-level" not in keys:
+        conf["compression-level"] = 6
+    elif not isinstance(conf["compression-level"], int) or not 1 <= conf["compression-level"] <= 9:
+        logger.critical("Invalid compression-level entry in %s, must be from 1 to 9" %conf_path)
+        valid = False
+    if "compression-workers" not in keys:
+        conf["compression-workers"] = 0
+    elif not isinstance(conf["compression-workers"], int) or conf["compression-workers"] < 0:
+        logger.critical("Invalid compression-workers entry in " + conf_path)
+        valid = False
+    if "store-extensions" not in keys:
+        conf["store-extensions"] = default_store_extensions
+    elif not isinstance(conf["store-extensions"], list) or not all(isinstance(extension, str) for extension in conf["store-extensions"]):
+        logger.critical("Invalid store-extensions entry in " + conf_path)
+        valid = False
+    else:
+        conf["store-extensions"] = [extension.lower() if extension.startswith(".") else "." + extension.lower() for extension in conf["store-extensions"]]
+    if "repository" not in keys:
+        conf["repository"] = False
+    elif not isinstance(conf["repository"], bool):
+        logger.critical("Invalid repository entry in " + conf_path)
+        valid = False
+    if "journal" not in keys:
+        conf["journal"] = False
+    elif not isinstance(conf["journal"], bool):
+        logger.critical("Invalid journal entry in " + conf_path)
+        valid = False
+    if "bandwidth-limit" not in keys:
+        conf["bandwidth-limit"] = 0
+    elif not isinstance(conf["bandwidth-limit"], (int, float)) or conf["bandwidth-limit"] < 0:
+        logger.critical("Invalid bandwidth-limit entry in " + conf_path)
+        valid = False
+    if "iops-limit" not in keys:
+        conf["iops-limit"] = 0
+    elif not isinstance(conf["iops-limit"], int) or conf["iops-limit"] < 0:
+        logger.critical("Invalid iops-limit entry in " + conf_path)
+        valid = False
+    if "low-priority" not in keys:
+        conf["low-priority"] = False
+    elif not isinstance(conf["low-priority"], bool):
+        logger.critical("Invalid low-priority entry in " + conf_path)
+        valid = False
+    if "delta-min-size" not in keys:
+        conf["delta-min-size"] = 0
+    elif not isinstance(conf["delta-min-size"], int) or conf["delta-min-size"] < 0:
+        logger.critical("Invalid delta-min-size entry in " + conf_path)
+        valid = False
+    if "delta-block-size" not in keys:
+        conf["delta-block-size"] = 256
+    elif not isinstance(conf["delta-block-size"], int) or conf["delta-block-size"] <= 0:
+        logger.critical("Invalid delta-block-size entry in " + conf_path)
+        valid = False
+    if "verify-after-backup" not in keys:
+        conf["verify-after-backup"] = False
+    elif not isinstance(conf["verify-after-backup"], bool):
+        logger.critical("Invalid verify-after-backup entry in " + conf_path)
+        valid = False
+    if "verify-workers" not in keys:
+        conf["verify-workers"] = 0
+    elif not isinstance(conf["verify-workers"], int) or conf["verify-workers"] < 0:
+        logger.critical("Invalid verify-workers entry in " + conf_path)
+        valid = False
+    if "source-options" not in keys:
+        conf["source-options"] = {}
+    elif not isinstance(conf["source-options"], dict):
+        logger.critical("Invalid source-options entry in " + conf_path)
+        valid = False
+    else:
+        sources: list = [os.path.abspath(path) for path in conf["source-directories"]] if isinstance(conf.get("source-directories"), list) else []
+        checks: dict = {
+            "workers": lambda value: isinstance(value, int) and value >= 1,
+            "bandwidth-limit": lambda value: isinstance(value, (int, float)) and value >= 0,
+            "iops-limit": lambda value: isinstance(value, int) and value >= 0,
+            "low-priority": lambda value: isinstance(value, bool),
+        }
+        for path, options in conf["source-options"].items():
+            if os.path.abspath(path) not in sources:
+                logger.critical("source-options entry %s in %s is not one of the source-directories" %(path, conf_path))
+                valid = False
+            elif not isinstance(options, dict) or not all(key in checks.keys() and checks[key](value) for key, value in options.items()):
+                logger.critical("Invalid source-options entry for %s in %s, it may set %s" %(path, conf_path, ", ".join(checks.keys())))
+                valid = False
+        conf["source-options"] = {os.path.abspath(path): options for path, options in conf["source-options"].items()}
+    if "destination-options" not in keys:
+        conf["destination-options"] = {}
+    elif not isinstance(conf["destination-options"], dict):
+        logger.critical("Invalid destination-options entry in " + conf_path)
         valid = False
     else:
-        if os.path.exists(records_path):
-            records: dict = toml.load(records_path)
-            if conf["use-md5"]:
-                if not bool(re.search("[A-z]", records[list(records.keys())[0]])):
-                    logger.critical("config says to use MD5, but record file is storing mtime")
-                    valid = False
+        destinations: dict = {os.path.abspath(destination): destination for destination in conf.get("destinations", [])}
+        retention: tuple = ("keep-full-backups", "keep-differential-backups", "keep-incremental-backups")
+        for path, options in list(conf["destination-options"].items()):
+            if os.path.abspath(path) not in destinations.keys():
+                logger.critical("destination-options entry %s in %s is not one of the destinations" %(path, conf_path))
+                valid = False
+            elif not isinstance(options, dict) or not all(key in retention and isinstance(value, int) and value >= 0 for key, value in options.items()):
+                logger.critical("Invalid destination-options entry for %s in %s, it may set %s" %(path, conf_path, ", ".join(retention)))
+                valid = False
             else:
-                if bool(re.search("[A-z]", records[list(records.keys())[0]])):
-                    logger.critical("config says to use mtime, but record file is storing MD5")
-                    valid = False
-                    
+                del conf["destination-options"][path]
+                conf["destination-options"][destinations[os.path.abspath(path)]] = options
+
     return valid
 
 def gen_stats_file(path: str):
@@ -126,12 +562,14 @@ def gen_stats_file(path: str):
 
     stats["full_backups"]: int = 0
     stats["diff_backups"]: int = 0
+    stats["incr_backups"]: int = 0
 
     stats["last_backup_type"]: int = 2
     stats["current-differential-backups"]: int = 0
 
     stats["last-full-timestamp"]: int = 0
     stats["last-diff-timestamp"]: int = 0
+    stats["last-incr-timestamp"]: int = 0
 
     with open(path, "w") as f:
         toml.dump(stats, f)
@@ -148,27 +586,260 @@ def print_stats(stats: dict, conf: dict):
 
     print("Total Full Backups: " + str(stats["full_backups"]))
     print("Total Differential Backups: " + str(stats["diff_backups"]))
-    print("Total Backups: " + str(stats["full_backups"] + stats["diff_backups"]) + "\n")
+    print("Total Incremental Backups: " + str(stats["incr_backups"]))
+    print("Total Backups: " + str(stats["full_backups"] + stats["diff_backups"] + stats["incr_backups"]) + "\n")
 
     backup_type: int = stats["last_backup_type"]
-    if backup_type == 0:
-        print("Last Backup Type: Full")
-    elif backup_type == 1:
-        print("Last Backup Type: Differential")
+    if backup_type in backup_types.keys():
+        print("Last Backup Type: " + backup_types[backup_type])
     else:
         print("No backup has been run yet")
     
-    print("Diff backups left before next Full backup: " + str(conf["differential-backups"] - stats["current-differential-backups"]))
+    if conf["incremental-backups"]:
+        print("Incremental backups left before next Full backup: " + str(conf["differential-backups"] - stats["current-differential-backups"]))
+    else:
+        print("Diff backups left before next Full backup: " + str(conf["differential-backups"] - stats["current-differential-backups"]))
 
     last_full: str = datetime.datetime.fromtimestamp(stats["last-full-timestamp"]).strftime("%m/%d/%Y %a %H:%M:%S")
     last_diff: str = datetime.datetime.fromtimestamp(stats["last-diff-timestamp"]).strftime("%m/%d/%Y %a %H:%M:%S")
+    last_incr: str = datetime.datetime.fromtimestamp(stats["last-incr-timestamp"]).strftime("%m/%d/%Y %a %H:%M:%S")
     print("Last Full Backup: " + last_full)
     print("Last Diff Backup: " + last_diff)
+    print("Last Incremental Backup: " + last_incr + "\n")
+
+    for destination in conf["destinations"]:
+        view: dict = destination_conf(conf, destination)
+        where: str = destination if len(conf["destinations"]) > 1 else "Destination"
+        catalog: list = load_catalog(view)
+        on_disk: dict = {"Full": 0, "Differential": 0, "Incremental": 0}
+        stored: int = 0
+        for entry in catalog:
+            on_disk[entry["type"]] += 1
+            if "index" not in entry.keys():
+                stored += entry.get("archive_size", entry.get("total_filesize", 0))
+        # repository backups share their chunks, so those are counted once
+        if os.path.isdir(repository_path(view)):
+            for path, dirs, names in os.walk(repository_path(view)):
+                stored += sum(os.stat(path + "/" + name).st_size for name in names)
+        print("Backups in %s: %d full, %d differential, %d incremental" %(where, on_disk["Full"], on_disk["Differential"], on_disk["Incremental"]))
+        print("Size of Backups in %s: %s" %(where, hr_size(stored)))
+        if len(catalog) > 0:
+            print("Most Recent Backup: " + catalog[-1]["name"])
 
 def write_toml(d: dict, path: str):
     with open(path, "w") as f:
         toml.dump(d, f)
 
+class TomlRecords:
+    def __init__(self, path: str, algorithm: str=None, load: bool=True):
+        self.path: str = path
+        self.algorithm: str = algorithm
+        # extra top-level keys, such as the backup these records describe
+        self.meta: dict = {}
+        self.files: dict = {}
+        self.dirty: bool = False
+        if load and os.path.exists(path):
+            data: dict = toml.load(path)
+            if "hash-algorithm" in data.keys() and isinstance(data.get("files"), dict):
+                self.algorithm = data.pop("hash-algorithm")
+                self.files = data.pop("files")
+                self.meta = data
+
+    @staticmethod
+    def peek(path: str):
+        # the header is always written before the files table, so there's no need to parse the whole file
+        header: str = ""
+        with open(path) as f:
+            for line in f:
+                if line.startswith("["):
+                    break
+                header += line
+        meta: dict = toml.loads(header)
+        records: TomlRecords = TomlRecords(path, meta.pop("hash-algorithm", None), load=False)
+        records.meta = meta
+        return records
+
+    def get(self, path: str):
+        return self.files.get(path)
+
+    def sorted_items(self, source: str):
+        for path in sorted(self.files.keys()):
+            if path.startswith(source + "/"):
+                yield path, self.files[path]
+
+    def put(self, path: str, record: dict):
+        self.files[path] = record
+        self.dirty = True
+
+    def rewrite(self, algorithm: str, keep: bool=False):
+        records: TomlRecords = TomlRecords(self.path, algorithm, load=False)
+        if keep:
+            records.files = dict(self.files)
+        records.dirty = True
+        return records
+
+    def commit(self):
+        if self.dirty:
+            data: dict = {"hash-algorithm": self.algorithm}
+            data.update(self.meta)
+            data["files"] = self.files
+            write_toml(data, self.path)
+            self.dirty = False
+
+    def close(self):
+        pass
+
+class SqliteRecords:
+    batch_size: int = 5000
+
+    def __init__(self, path: str, algorithm: str=None, connection: sqlite3.Connection=None, table: str="files"):
+        self.path: str = path
+        self.table: str = table
+        self.pending: list = []
+        if connection is None:
+            connection = sqlite3.connect(path, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection: sqlite3.Connection = connection
+        # the path primary key doubles as the lookup index
+        self.connection.execute("CREATE TABLE IF NOT EXISTS %s (path TEXT PRIMARY KEY, hash TEXT NOT NULL, size INTEGER, mtime_ns INTEGER, inode INTEGER, ctime_ns INTEGER) WITHOUT ROWID" %table)
+        self.algorithm: str = algorithm
+        self.meta: dict = {}
+        if algorithm is None:
+            self.meta = dict(self.connection.execute("SELECT key, value FROM meta").fetchall())
+            self.algorithm = self.meta.pop("hash-algorithm", None)
+
+    @staticmethod
+    def row_record(row: tuple):
+        if row[1] is None:
+            return {"hash": row[0], "stat": None}
+        return {"hash": row[0], "stat": list(row[1:])}
+
+    def get(self, path: str):
+        row = self.connection.execute("SELECT hash, size, mtime_ns, inode, ctime_ns FROM %s WHERE path = ?" %self.table, (path,)).fetchone()
+        if row is None:
+            return None
+        return self.row_record(row)
+
+    def sorted_items(self, source: str):
+        # a connection of its own reads a snapshot, so records written during the walk never show up in the cursor.
+        # "0" is the character after "/", so the range holds exactly the paths under source
+        reader: sqlite3.Connection = sqlite3.connect(self.path)
+        try:
+            for row in reader.execute("SELECT path, hash, size, mtime_ns, inode, ctime_ns FROM %s WHERE path > ? AND path < ? ORDER BY path" %self.table, (source + "/", source + "0")):
+                yield row[0], self.row_record(row[1:])
+        finally:
+            reader.close()
+
+    def put(self, path: str, record: dict):
+        st: list = record["stat"] if record["stat"] is not None else [None] * 4
+        self.pending.append((path, record["hash"], *st))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        self.connection.execute("BEGIN")
+        self.connection.executemany("INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?)" %self.table, self.pending)
+        self.connection.execute("COMMIT")
+        self.pending = []
+
+    def rewrite(self, algorithm: str, keep: bool=False):
+        # a full backup builds its records in a side table and swaps it in once the run completes
+        self.connection.execute("DROP TABLE IF EXISTS files_new")
+        records: SqliteRecords = SqliteRecords(self.path, algorithm, self.connection, "files_new")
+        if keep:
+            self.connection.execute("INSERT INTO files_new SELECT * FROM files")
+        return records
+
+    def commit(self):
+        self.flush()
+        self.connection.execute("BEGIN")
+        if self.table != "files":
+            self.connection.execute("DROP TABLE files")
+            self.connection.execute("ALTER TABLE %s RENAME TO files" %self.table)
+            self.table = "files"
+        self.connection.execute("DELETE FROM meta")
+        self.connection.execute("INSERT INTO meta VALUES ('hash-algorithm', ?)", (self.algorithm,))
+        self.connection.executemany("INSERT INTO meta VALUES (?, ?)", self.meta.items())
+        self.connection.execute("COMMIT")
+
+    def close(self):
+        self.connection.close()
+
+def upgrade_toml_records(path: str, algorithm: str):
+    # records.toml from before records were tagged is a flat table of path = hash. The hashes say which algorithm wrote them,
+    # as the old use-md5 check did, and the file is rewritten once in the tagged layout so this never has to be guessed again
+    if not os.path.exists(path) or TomlRecords.peek(path).algorithm is not None:
+        return
+    data: dict = toml.load(path)
+    if "files" in data.keys() or not all(isinstance(value, str) for value in data.values()):
+        return
+    if len(data) > 0:
+        algorithm = "md5" if re.search("[A-Za-z]", next(iter(data.values()))) is not None else "mtime"
+    logger.info("Upgrading %s to the current layout; it stores %s" %(path, algorithm))
+    records: TomlRecords = TomlRecords(path, algorithm, load=False)
+    records.files = data
+    records.dirty = True
+    records.commit()
+
+def migrate_toml_records(toml_path: str, db_path: str):
+    logger.info("Migrating records from %s to %s" %(toml_path, db_path))
+    old: TomlRecords = TomlRecords(toml_path)
+    new: SqliteRecords = SqliteRecords(db_path, old.algorithm).rewrite(old.algorithm)
+    for path, record in old.files.items():
+        if not isinstance(record, dict):
+            record = {"hash": record, "stat": None}
+        new.put(path, record)
+    new.commit()
+    new.close()
+    os.rename(toml_path, toml_path + ".migrated")
+    logger.info("Migrated %d records; the old file was kept at %s.migrated" %(len(old.files), toml_path))
+
+def records_db_exists(path: str):
+    # the database is created when a run starts but only tagged with its hash algorithm when it commits,
+    # so one left by a first full backup that never finished holds no records
+    if not os.path.exists(path):
+        return False
+    connection: sqlite3.Connection = sqlite3.connect(path)
+    try:
+        return connection.execute("SELECT 1 FROM meta WHERE key = 'hash-algorithm'").fetchone() is not None
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
+def records_exist(conf: dict, head: bool=False):
+    if head:
+        return records_db_exists(records_head_db_path) if conf["records-backend"] == "sqlite" else os.path.exists(records_head_path)
+    if conf["records-backend"] == "sqlite":
+        return records_db_exists(records_db_path) or os.path.exists(records_path)
+    return os.path.exists(records_path)
+
+def open_records(conf: dict, peek: bool=False, head: bool=False):
+    # the base records describe the last full backup, the head records the last backup of any kind
+    if conf["records-backend"] == "sqlite":
+        if head:
+            return SqliteRecords(records_head_db_path)
+        if os.path.exists(records_path) and not records_db_exists(records_db_path):
+            migrate_toml_records(records_path, records_db_path)
+        return SqliteRecords(records_db_path)
+    path: str = records_head_path if head else records_path
+    if peek and os.path.exists(path):
+        return TomlRecords.peek(path)
+    return TomlRecords(path)
+
+def record_stat(st: os.stat_result):
+    return [st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns]
+
+def record_hash(record):
+    # records written before stat caching store the bare hash
+    if isinstance(record, dict):
+        return record["hash"]
+    return record
+
 def confirm(question: str, default_yes: bool=True, default_no: bool=False):
     if default_yes:
         response: str = input(question + " (Y/n) ")
@@ -210,244 +881,2404 @@ def item_size(path: str):
     size: float = float(os.stat(path).st_size)
     return hr_size(size)
 
-def is_ignored(conf: dict, item: str):
-    for pattern in conf["ignored"]:
-        if bool(re.match(pattern, item)):
-            return True
+def compile_patterns(patterns: list):
+    # joining patterns renumbers their groups, which breaks backreferences like \1, so those stay on their own
+    compiled: list = [re.compile(pattern) for pattern in patterns]
+    grouped: list = [regex for regex in compiled if regex.groups > 0]
+    plain: list = [regex.pattern for regex in compiled if regex.groups == 0]
+    if len(plain) < 2:
+        return compiled
+    try:
+        return [re.compile("|".join("(?:%s)" %pattern for pattern in plain))] + grouped
+    except re.error:
+        # e.g. inline flags that are only allowed at the start of an expression
+        return compiled
+
+class IgnoreMatcher:
+    def __init__(self, patterns: list):
+        self.name_patterns: list = [pattern for pattern in patterns if "/" not in pattern]
+        self.path_patterns: list = [pattern for pattern in patterns if "/" in pattern]
+        self.names: list = compile_patterns(self.name_patterns)
+        self.paths: list = compile_patterns(self.path_patterns)
+
+    def match(self, name: str, rel: str):
+        for regex in self.names:
+            if regex.match(name) is not None:
+                return True
+        for regex in self.paths:
+            if regex.match(rel) is not None:
+                return True
+        return False
+
+    def explain(self, name: str, rel: str):
+        for pattern in self.name_patterns:
+            if re.match(pattern, name) is not None:
+                return pattern
+        for pattern in self.path_patterns:
+            if re.match(pattern, rel) is not None:
+                return pattern
+        return None
+
+def explain_ignore(conf: dict, path: str):
+    path = os.path.abspath(path)
+    for source in conf["source-directories"]:
+        source = os.path.abspath(source)
+        if path != source and not path.startswith(source + "/"):
+            continue
+        # an item is also skipped when any directory above it is ignored
+        rel: str = ""
+        for name in os.path.relpath(path, source).split("/"):
+            rel = name if rel == "" else rel + "/" + name
+            if name == ".":
+                break
+            pattern: str = ignore_matcher.explain(name, rel)
+            if pattern is not None:
+                if rel == os.path.relpath(path, source):
+                    print("%s is ignored by pattern %s" %(path, pattern))
+                else:
+                    print("%s is ignored because %s/%s is ignored by pattern %s" %(path, source, rel, pattern))
+                return True
+        print("%s is not ignored" %path)
+        return False
+    print("%s is not inside any source directory" %path)
     return False
 
-def full_backup(conf: dict, compress=True):
-    working_dir: str = os.path.abspath(os.curdir)
-    now: str = datetime.datetime.now().strftime("%m-%d-%Y_%a_%H-%M-%S")
-    records: dict = {}
-    destination_path: str = conf["destination"] + "Full_" + now
+def scan_dir(path: str, rel: str):
+    with os.scandir(path) as it:
+        for item in it:
+            item_rel: str = item.name if rel == "" else rel + "/" + item.name
+            if ignore_matcher.match(item.name, item_rel):
+                logger.info("Skipping item " + item_rel)
+                metrics.count("ignored")
+                continue
+
+            logger.debug("Backing up item " + item_rel)
+            if item.is_dir():
+                yield Entry(item.path, item.name, item_rel, True, None)
+            else:
+                yield Entry(item.path, item.name, item_rel, False, item.stat())
 
-    backup_record: dict = {}
-    backup_record["total_filesize"]: int = 0
-    backup_record["total_files"]: int = 0
-    backup_record["total_directories"]: int = 0
+def ignored_path(rel: str):
+    # a path is skipped if any directory above it would have been skipped by the walk
+    parts: list = rel.split("/")
+    for i in range(0, len(parts)):
+        if ignore_matcher.match(parts[i], "/".join(parts[:i + 1])):
+            return True
+    return False
 
+def open_journal():
+    journal: sqlite3.Connection = sqlite3.connect(journal_path, isolation_level=None, timeout=30)
+    journal.execute("PRAGMA journal_mode=WAL")
+    journal.execute("PRAGMA synchronous=NORMAL")
+    journal.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL)")
+    # valid_since is when the watcher last started or lost events for a source; NULL if it can't watch all of it
+    journal.execute("CREATE TABLE IF NOT EXISTS watchers (source TEXT PRIMARY KEY, pid INTEGER, valid_since REAL)")
+    journal.execute("CREATE TABLE IF NOT EXISTS dirty (source TEXT, path TEXT, changed REAL, PRIMARY KEY (source, path)) WITHOUT ROWID")
+    return journal
+
+def process_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Watcher:
+    flush_interval: float = 1.0
+    flush_size: int = 5000
+
+    def __init__(self, conf: dict):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.libc.inotify_init1.argtypes = [ctypes.c_int]
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd: int = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            error: int = ctypes.get_errno()
+            raise OSError(error, "inotify_init1: " + os.strerror(error))
+        self.sources: list = [os.path.abspath(source) for source in conf["source-directories"]]
+        # wd -> (source, directory)
+        self.watches: dict = {}
+        # (source, path) -> time of the last event
+        self.pending: dict = {}
+        self.valid_since: dict = {}
+        self.journal: sqlite3.Connection = open_journal()
+        self.last_flush: float = time.monotonic()
+        self.synced: float = 0.0
+
+    def add_tree(self, source: str, path: str, mark: bool):
+        # new or moved in directories have their files marked as well, since they may have been written before the watch existed
+        stack: list = [path]
+        while len(stack) > 0:
+            directory: str = stack.pop()
+            wd: int = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), watch_mask)
+            if wd < 0:
+                error: int = ctypes.get_errno()
+                if error not in (errno.ENOENT, errno.ENOTDIR):
+                    logger.critical("Could not watch %s (%s); backups will walk %s until the watcher is restarted" %(directory, os.strerror(error), source))
+                    self.valid_since[source] = None
+                continue
+            self.watches[wd] = (source, directory)
+            try:
+                with os.scandir(directory) as it:
+                    for item in it:
+                        if ignored_path(item.path[len(source) + 1:]):
+                            continue
+                        if item.is_dir():
+                            stack.append(item.path)
+                        elif mark:
+                            self.pending[(source, item.path)] = time.time()
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+    def drop_tree(self, path: str):
+        for wd, (source, directory) in list(self.watches.items()):
+            if directory == path or directory.startswith(path + "/"):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def handle(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            # events were dropped, so nothing before now can be trusted
+            logger.warning("inotify queue overflowed; the next backups will walk the source directories")
+            for source in self.sources:
+                if self.valid_since[source] is not None:
+                    self.valid_since[source] = time.time()
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        if wd not in self.watches.keys() or name == "":
+            return
+        source, directory = self.watches[wd]
+        path: str = directory + "/" + name
+        if ignored_path(path[len(source) + 1:]):
+            return
+        self.pending[(source, path)] = time.time()
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(source, path, True)
+            elif mask & IN_MOVED_FROM:
+                self.drop_tree(path)
+
+    def read_events(self, timeout: float):
+        while len(select.select([self.fd], [], [], timeout)[0]) > 0:
+            data: bytes = os.read(self.fd, 64 * 1024)
+            offset: int = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+                name: str = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+                self.handle(wd, mask, name)
+                offset += 16 + length
+            timeout = 0
+
+    def flush(self):
+        self.journal.execute("BEGIN")
+        self.journal.executemany("INSERT OR REPLACE INTO dirty VALUES (?, ?, ?)", [(source, path, changed) for (source, path), changed in self.pending.items()])
+        self.journal.executemany("INSERT OR REPLACE INTO watchers VALUES (?, ?, ?)", [(source, os.getpid(), self.valid_since[source]) for source in self.sources])
+        self.journal.execute("COMMIT")
+        if len(self.pending) > 0:
+            logger.debug("Journaled %d changed paths" %len(self.pending))
+        self.pending = {}
+        self.last_flush = time.monotonic()
+
+    def run(self):
+        for source in self.sources:
+            self.valid_since[source] = 0.0
+            self.add_tree(source, source, False)
+        # events are only complete from once every directory is watched
+        started: float = time.time()
+        for source in self.sources:
+            if self.valid_since[source] is not None:
+                self.valid_since[source] = started
+        self.pending = {}
+        self.flush()
+        logger.info("Watching %d directories under %s" %(len(self.watches), ", ".join(self.sources)))
+        try:
+            while True:
+                self.read_events(0.5)
+                # a backup asks for everything seen so far to be written before it reads the journal
+                row = self.journal.execute("SELECT value FROM meta WHERE key = 'sync-requested'").fetchone()
+                requested: float = row[0] if row is not None else 0.0
+                if requested > self.synced:
+                    self.read_events(0)
+                    self.flush()
+                    self.journal.execute("INSERT OR REPLACE INTO meta VALUES ('synced', ?)", (requested,))
+                    self.synced = requested
+                elif len(self.pending) >= self.flush_size or (len(self.pending) > 0 and time.monotonic() - self.last_flush >= self.flush_interval):
+                    self.flush()
+        finally:
+            # once the watcher stops, the journal no longer covers anything
+            self.journal.execute("DELETE FROM watchers WHERE pid = ?", (os.getpid(),))
+            self.journal.close()
+            os.close(self.fd)
+
+def watch(conf: dict):
+    if not sys.platform.startswith("linux"):
+        logger.critical("--watch needs Linux inotify")
+        return False
+    # SIGTERM from a service manager unwinds like Ctrl+C, so the watcher rows are removed on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        Watcher(conf).run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    logger.info("Stopped watching")
+    return True
+
+def journal_changes(conf: dict, since: float):
+    # changed paths per source, for the sources the journal has covered without gaps since the given time
+    if not os.path.exists(journal_path):
+        return {}
+    journal: sqlite3.Connection = open_journal()
     try:
-        logger.info("Creating destination path at " + destination_path)
-        os.makedirs(destination_path)
-    except FileExistsError:
-        logger.warning("Destination path already exists")
-        if confirm("The destination folder already exists at %s. Remove?" %destination_path, False, True): 
-            logger.debug("User chose to remove the existing directory at destination path")
-            rmtree(destination_path)
-            os.makedirs(destination_path)
+        watchers: list = journal.execute("SELECT source, pid, valid_since FROM watchers").fetchall()
+        if not any(process_alive(pid) for source, pid, valid_since in watchers):
+            logger.info("The change journal watcher isn't running")
+            return {}
+        requested: float = time.time()
+        journal.execute("INSERT OR REPLACE INTO meta VALUES ('sync-requested', ?)", (requested,))
+        deadline: float = time.monotonic() + journal_sync_timeout
+        while True:
+            row = journal.execute("SELECT value FROM meta WHERE key = 'synced'").fetchone()
+            if row is not None and row[0] >= requested:
+                break
+            if time.monotonic() > deadline:
+                logger.warning("The change journal watcher didn't respond within %d seconds" %journal_sync_timeout)
+                return {}
+            time.sleep(0.05)
+
+        changes: dict = {}
+        # read again after the sync in case the queue overflowed in the meantime
+        for source, pid, valid_since in journal.execute("SELECT source, pid, valid_since FROM watchers").fetchall():
+            if valid_since is None or valid_since > since or not process_alive(pid):
+                continue
+            changes[source] = [row[0] for row in journal.execute("SELECT path FROM dirty WHERE source = ? AND changed >= ? ORDER BY path", (source, since))]
+        return changes
+    finally:
+        journal.close()
+
+def prune_journal(before: float):
+    # nothing can ask for changes from before the last full backup
+    if not os.path.exists(journal_path):
+        return
+    journal: sqlite3.Connection = open_journal()
+    journal.execute("DELETE FROM dirty WHERE changed < ?", (before,))
+    journal.close()
+
+class TokenBucket:
+    def __init__(self, rate: float):
+        self.rate: float = rate
+        # tokens and the time they were last topped up live in shared memory, so worker processes draw from the same bucket
+        self.state = multiprocessing.Array("d", [rate, time.monotonic()])
+
+    def take(self, amount: float):
+        # callers go into debt and sleep it off, so concurrent callers queue up behind each other.
+        # At most a second's worth of tokens builds up while nothing is drawing
+        with self.state.get_lock():
+            now: float = time.monotonic()
+            tokens: float = min(self.rate, self.state[0] + (now - self.state[1]) * self.rate) - amount
+            self.state[0] = tokens
+            self.state[1] = now
+        if tokens < 0:
+            time.sleep(-tokens / self.rate)
+
+class Throttle:
+    def __init__(self, bandwidth: float=0, iops: float=0):
+        self.overall: tuple = self.buckets(bandwidth, iops)
+        self.source: tuple = (None, None)
+        self.enabled: bool = self.overall != (None, None)
+
+    @staticmethod
+    def buckets(bandwidth: float, iops: float):
+        return TokenBucket(bandwidth * 1000000) if bandwidth > 0 else None, TokenBucket(iops) if iops > 0 else None
+
+    def limit_source(self, bandwidth: float=0, iops: float=0):
+        self.source = self.buckets(bandwidth, iops)
+        self.enabled = self.overall != (None, None) or self.source != (None, None)
+
+    def take(self, size: int, operations: int=1):
+        if not self.enabled:
+            return
+        for bandwidth, iops in (self.overall, self.source):
+            if bandwidth is not None and size > 0:
+                bandwidth.take(size)
+            if iops is not None:
+                iops.take(operations)
+
+throttle: Throttle = Throttle()
+
+def init_worker(overall: tuple):
+    # hash and chunk worker processes draw from the overall buckets; the source limits change under them, so they don't apply
+    global throttle
+    throttle = Throttle()
+    throttle.overall = overall
+    throttle.enabled = overall != (None, None)
+
+def set_io_class(io_class: int):
+    # ioprio_set works on single threads, so every thread of this process and of its worker processes is changed.
+    # Threads started afterwards inherit the class from the thread that starts them
+    number: int = ioprio_syscalls.get(platform.machine())
+    if number is None or not os.path.isdir("/proc/self/task"):
+        logger.warning("I/O priorities aren't supported on this platform")
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    value: int = io_class << IOPRIO_CLASS_SHIFT | (4 if io_class == IOPRIO_CLASS_BE else 0)
+    for pid in [os.getpid()] + [child.pid for child in multiprocessing.active_children()]:
+        try:
+            threads: list = os.listdir("/proc/%d/task" %pid)
+        except FileNotFoundError:
+            continue
+        for tid in threads:
+            if libc.syscall(number, IOPRIO_WHO_PROCESS, int(tid), value) != 0 and ctypes.get_errno() != errno.ESRCH:
+                logger.warning("Could not set the I/O priority: " + os.strerror(ctypes.get_errno()))
+                return False
+    return True
+
+def lower_priority():
+    os.nice(19)
+    if set_io_class(IOPRIO_CLASS_IDLE):
+        logger.info("Running at nice 19 in the idle I/O class")
+
+def copy_stream(src, dst):
+    # copyfileobj, paying for every read and write
+    while True:
+        chunk: bytes = src.read(hash_chunk_size)
+        if len(chunk) == 0:
+            break
+        dst.write(chunk)
+        throttle.take(2 * len(chunk), 2)
+
+def hash_file(path: str, algorithm: str):
+    # one buffer per thread/process, reused for every file it hashes
+    buffer: bytearray = getattr(hash_buffer, "buffer", None)
+    if buffer is None:
+        buffer = bytearray(hash_chunk_size)
+        hash_buffer.buffer = buffer
+    view: memoryview = memoryview(buffer)
+    digest = hashlib.new(algorithm)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            read: int = f.readinto(buffer)
+            if read == 0:
+                break
+            throttle.take(read)
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+def hash_files(paths: list, algorithm: str):
+    # one job on the hash pool
+    return [hash_file(path, algorithm) for path in paths]
+
+class HashPool:
+    def __init__(self, algorithm: str, workers: int, rehash_all: bool=False):
+        self.algorithm: str = algorithm
+        self.rehash_all: bool = rehash_all
+        self.workers: int = workers if workers > 0 else (os.cpu_count() or 1)
+        self.executor: ProcessPoolExecutor = None
+        if algorithm != "mtime" and self.workers > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=(throttle.overall,))
+        # hash jobs the pool hasn't finished, across every batch looked up so far
+        self.running: int = 0
+        self.lock: threading.Lock = threading.Lock()
+
+    def cached(self, record, st: os.stat_result):
+        if self.algorithm == "mtime":
+            return str(st.st_mtime)
+        if self.rehash_all or not isinstance(record, dict) or record["stat"] != record_stat(st):
+            return None
+        return record["hash"]
+
+    def lookup(self, entries: list, records, cache=None):
+        # only hash files whose size, mtime, inode or ctime differ from the records, or from the cache if one is given.
+        # The pool starts on them straight away; results() waits for them
+        looked_up: list = [(entry, records.get(entry.path)) for entry in entries]
+        if cache is None:
+            compares: list = [self.cached(record, entry.stat) for entry, record in looked_up]
         else:
-            logger.critical("User chose to leave the existing directory")
-            write_log()
-            exit(1)
-    for path in conf["source-directories"]:
-        logger.info("Creating destination directory for " + path)
-        os.makedirs(destination_path + "/" + item_from_path(path))
-
-        logger.info("Destination created. Backing up " + path)
-        dir_record: dict = backup_dir(True, path, destination_path + "/" + item_from_path(path), records, conf["use-md5"])
+            compares = [self.cached(cache.get(entry.path), entry.stat) or self.cached(record, entry.stat) for entry, record in looked_up]
+        stale: list = [entry for (entry, _), compare in zip(looked_up, compares) if compare is None]
+        if self.algorithm != "mtime":
+            metrics.count("hash_cache_hits", len(entries) - len(stale))
+        hashes: list = None
+        if self.executor is not None and len(stale) > 0:
+            paths: list = [entry.path for entry in stale]
+            size: int = max(1, len(paths) // (self.workers * 4))
+            hashes = []
+            for i in range(0, len(paths), size):
+                with self.lock:
+                    self.running += 1
+                hashes.append(self.executor.submit(hash_files, paths[i:i + size], self.algorithm))
+                hashes[-1].add_done_callback(self._done)
+        return looked_up, compares, stale, hashes
+
+    def _done(self, future):
+        with self.lock:
+            self.running -= 1
+
+    def waiting(self, batch: tuple):
+        # whether the pool is still hashing files of the batch
+        return batch[3] is not None and not all(future.done() for future in batch[3])
+
+    def busy(self):
+        return self.running >= self.workers * 4
+
+    def results(self, batch: tuple):
+        looked_up, compares, stale, hashes = batch
+        start: float = time.perf_counter()
+        if hashes is None:
+            hashed: list = self.hash_many([entry.path for entry in stale])
+        else:
+            hashed = [digest for future in hashes for digest in future.result()]
+        if self.algorithm != "mtime" and len(stale) > 0:
+            # with the pool this is only the time spent waiting for it
+            metrics.add("hash", time.perf_counter() - start, len(stale), sum(entry.stat.st_size for entry in stale))
+        digests = iter(hashed)
+        for (entry, record), compare in zip(looked_up, compares):
+            if compare is None:
+                yield entry, record, next(digests), True
+            else:
+                yield entry, record, compare, False
+
+    def check(self, entries: list, records, cache=None):
+        return self.results(self.lookup(entries, records, cache))
+
+    def hash_many(self, paths: list):
+        if self.algorithm == "mtime":
+            return [str(os.path.getmtime(path)) for path in paths]
+        return [hash_file(path, self.algorithm) for path in paths]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+class Destinations:
+    # the backup folders the copiers write the same files into. One that fails is dropped and the others carry on
+    def __init__(self, roots: list):
+        self.roots: list = [os.path.abspath(root) for root in roots]
+        self.failed: dict = {}
+        self.lock: threading.Lock = threading.Lock()
+
+    def live(self):
+        return [root for root in self.roots if root not in self.failed.keys()]
+
+    def targets(self, destination: str):
+        # the walk builds its paths under the first folder
+        rel: str = os.path.abspath(destination)[len(self.roots[0]):]
+        return [(root, root + rel) for root in self.live()]
+
+    def fail(self, root: str, error: Exception):
+        with self.lock:
+            if root in self.failed.keys():
+                return
+            self.failed[root] = error
+        logger.error("Backup to %s failed and won't be completed: %s" %(root, str(error)))
+        if len(self.live()) == 0:
+            raise error
+
+class CopyPool:
+    def __init__(self, workers: int, destinations: Destinations=None, link_from: dict=None):
+        self.workers: int = workers
+        self.destinations: Destinations = destinations
+        # the previous snapshot in each destination that has one
+        self.link_from: dict = link_from or {}
+        self.errors: list = []
+        self.executor: ThreadPoolExecutor = None
+        if workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="copy")
+            # bound the number of queued copies so the walk can't run arbitrarily far ahead
+            self.slots: threading.BoundedSemaphore = threading.BoundedSemaphore(workers * 4)
+
+    def begin_dir(self, destination: str):
+        for root, path in self.destinations.targets(destination):
+            try:
+                # a resumed backup already has some of its directories
+                os.makedirs(path, exist_ok=True)
+            except OSError as e:
+                self.destinations.fail(root, e)
+
+    def end_dir(self, source: str, destination: str, keep: bool):
+        if not keep:
+            for root, path in self.destinations.targets(destination):
+                try:
+                    os.rmdir(path)
+                except OSError as e:
+                    self.destinations.fail(root, e)
+
+    def resume(self, source: str, destination: str, st: os.stat_result):
+        # copies set the mtime last and links are atomic, so a matching mtime means the file was finished
+        for root, path in self.destinations.targets(destination):
+            try:
+                done: os.stat_result = os.stat(path)
+            except FileNotFoundError:
+                return False
+            if done.st_size != st.st_size or done.st_mtime_ns != st.st_mtime_ns:
+                return False
+        return True
 
-        backup_record["total_filesize"] += dir_record["total_filesize"]
-        backup_record["total_files"] += dir_record["total_files"]
-        backup_record["total_directories"] += dir_record["total_directories"]
-    
-    os.chdir(destination_path)
-    if compress:
+    def limit(self, workers: int=None):
+        # a source with its own workers setting gets at most that many copies in flight at once
+        if self.executor is not None:
+            self.slots = threading.BoundedSemaphore(workers if workers is not None else self.workers * 4)
+
+    def submit(self, source: str, destination: str, st: os.stat_result):
+        self.run(self.copy, source, self.destinations.targets(destination), st.st_size)
+
+    def scratch_path(self, destination: str):
+        # a file made for the backup, like a delta, is written straight to its place in the first destination
+        return self.destinations.targets(destination)[0]
+
+    def submit_scratch(self, path: str, destination: str, st: os.stat_result):
+        # and copied from there to the others
+        targets: list = [(root, target) for root, target in self.destinations.targets(destination) if target != path]
+        if len(targets) > 0:
+            self.run(self.copy, path, targets, st.st_size)
+
+    def can_link(self):
+        return len(self.link_from) > 0
+
+    def link(self, source: str, destination: str, st: os.stat_result):
+        # the same file in the previous snapshot, which the records say is still identical to source
+        rel: str = os.path.abspath(destination)[len(self.destinations.roots[0]):]
+        copies: list = []
+        for root, path in self.destinations.targets(destination):
+            if root in self.link_from.keys():
+                self.run(self.copy, source, [(root, path)], st.st_size, self.link_from[root] + rel)
+            else:
+                copies.append((root, path))
+        if len(copies) > 0:
+            self.run(self.copy, source, copies, st.st_size)
+
+    def copy(self, source: str, targets: list, size: int, previous: str=None):
+        if len(targets) > 1:
+            tee_file(source, targets, size, self.destinations)
+            return
+        root, path = targets[0]
+        try:
+            if previous is not None:
+                link_file(previous, source, path, size)
+            else:
+                copy_file(source, path, size)
+        except OSError as e:
+            # trouble with the source fails the backup as before, anything else only this destination
+            if e.filename == source:
+                raise
+            self.destinations.fail(root, e)
+
+    def run(self, task, *args):
+        if self.executor is None:
+            task(*args)
+            return
+        slots: threading.BoundedSemaphore = self.slots
+        slots.acquire()
+        try:
+            future = self.executor.submit(task, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda future: self._done(future, slots))
+
+    def _done(self, future, slots: threading.BoundedSemaphore):
+        slots.release()
+        error = future.exception()
+        if error is not None:
+            logger.error("Copy failed: " + str(error))
+            self.errors.append(error)
+
+    def join(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+def close_quietly(f):
+    # the destination is already being given up on, so a second error closing it doesn't matter
+    try:
+        f.close()
+    except OSError:
+        pass
+
+def tee_file(source: str, targets: list, size: int, destinations: Destinations):
+    # one read of the source feeds every destination
+    start: float = time.perf_counter()
+    outputs: list = []
+    try:
+        for root, path in targets:
+            try:
+                outputs.append((root, path, open(path, "wb")))
+            except OSError as e:
+                destinations.fail(root, e)
+        with open(source, "rb") as src:
+            while len(outputs) > 0:
+                chunk: bytes = src.read(hash_chunk_size)
+                if len(chunk) == 0:
+                    break
+                throttle.take(len(chunk) * (len(outputs) + 1), len(outputs) + 1)
+                for output in list(outputs):
+                    try:
+                        output[2].write(chunk)
+                    except OSError as e:
+                        outputs.remove(output)
+                        close_quietly(output[2])
+                        destinations.fail(output[0], e)
+        for output in list(outputs):
+            try:
+                output[2].close()
+                copystat(source, output[1])
+            except OSError as e:
+                outputs.remove(output)
+                destinations.fail(output[0], e)
+    finally:
+        for output in outputs:
+            close_quietly(output[2])
+    elapsed: float = time.perf_counter() - start
+    metrics.add("copy", elapsed, 1, size)
+    metrics.file_time(source, elapsed, size)
+    logger.info("Backed up " + source)
+
+def kernel_copy(source: str, destination: str):
+    # copy_file_range keeps the data in the kernel and lets filesystems that support it reflink or copy server-side.
+    # shutil's own fallback already tries sendfile before a plain read/write loop
+    if hasattr(os, "copy_file_range"):
         try:
-            logger.info("Finished copying source directories. Archiving")
-            make_archive("Full_" + now, "zip", destination_path)
-        except ValueError as e:
-            logger.error("Error occured during creation of archive: " + str(e))
-        logger.info("Archive created. Removing working files")
-        for file in os.listdir(destination_path):
-            if os.path.isdir(file):
-                logger.debug("Removing " + file)
-                rmtree(destination_path + "/" + file)
-        with ZipFile("Full_" + now + ".zip") as z:
-            logger.info("Full backup completed. Backed up %d items with a compressed size of %s" %(len(z.infolist()) - 2, item_size(destination_path + "/Full_" + now + ".zip")))
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                size: int = os.fstat(src.fileno()).st_size
+                copied: int = 0
+                while copied < size:
+                    # a throttled copy goes a chunk at a time so it can pay as it goes
+                    sent: int = os.copy_file_range(src.fileno(), dst.fileno(), min(size - copied, hash_chunk_size) if throttle.enabled else size - copied)
+                    if sent == 0:
+                        break
+                    copied += sent
+                    throttle.take(2 * sent, 2)
+                # the file may have grown since it was statted
+                while True:
+                    sent = os.copy_file_range(src.fileno(), dst.fileno(), hash_chunk_size)
+                    if sent == 0:
+                        break
+                    throttle.take(2 * sent, 2)
+            copystat(source, destination)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                raise
+    if throttle.enabled:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            copy_stream(src, dst)
+        copystat(source, destination)
     else:
-        items: int = backup_record["total_directories"] + backup_record["total_files"]
-        logger.info("Full backup completed. Backed up %d items with a total size of %s" %(items, hr_size(backup_record["total_filesize"])))
+        copy(source, destination)
+
+def copy_file(source: str, destination: str, size: int):
+    start: float = time.perf_counter()
+    kernel_copy(source, destination)
+    elapsed: float = time.perf_counter() - start
+    metrics.add("copy", elapsed, 1, size)
+    metrics.file_time(source, elapsed, size)
+    logger.info("Backed up " + source)
+
+def link_file(previous: str, source: str, destination: str, size: int):
+    start: float = time.perf_counter()
+    try:
+        os.link(previous, destination)
+        throttle.take(0)
+        metrics.add("link", time.perf_counter() - start, 1, size)
+        logger.debug("Linked %s from %s" %(source, previous))
+    except OSError as e:
+        logger.debug("Could not link %s (%s), copying it instead" %(previous, str(e)))
+        copy_file(source, destination, size)
+
+def compress_file(source: str, method: int, level: int):
+    # runs on a compression thread; zlib, bz2 and lzma release the GIL while they work
+    start: float = time.perf_counter()
+    crc: int = 0
+    size: int = 0
+    compressor = _get_compressor(method, level)
+    with open(source, "rb") as src:
+        sample: bytes = src.read(compression_sample_size)
+        throttle.take(len(sample))
+        if len(sample) == compression_sample_size and len(zlib.compress(sample, 1)) > len(sample) * (1 - compression_min_saving):
+            return None
+        # only files up to compression_spool_size get here, so this stays in memory
+        data = SpooledTemporaryFile(max_size=compression_spool_size * 2)
+        chunk: bytes = sample
+        while len(chunk) > 0:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data.write(compressor.compress(chunk))
+            chunk = src.read(hash_chunk_size)
+            throttle.take(len(chunk))
+    data.write(compressor.flush())
+    if size < compression_sample_size and data.tell() >= size:
+        # too small for the sample to have decided, and compressing didn't help
+        data.close()
+        return None
+    metrics.add("compress", time.perf_counter() - start, 1, size)
+    metrics.file_time(source, time.perf_counter() - start, size)
+    return data, crc, size
+
+def recover_zip(path: str):
+    # an interrupted archive has no central directory, so its entries are found by walking the local headers.
+    # Entries are only trusted up to the first one that isn't complete
+    recovered: dict = {}
+    end: int = 0
+    with open(path, "rb") as f:
+        size: int = os.fstat(f.fileno()).st_size
+        while end + 30 <= size:
+            f.seek(end)
+            header: bytes = f.read(30)
+            signature, version, flags, method, dos_time, dos_date, crc, compress_size, file_size, name_length, extra_length = struct.unpack("<4s5H3L2H", header)
+            # data descriptors are only used for unseekable output, which an archive in the destination never is
+            if signature != b"PK\x03\x04" or flags & 0x08:
+                break
+            name: bytes = f.read(name_length)
+            extra: bytes = f.read(extra_length)
+            offset: int = 0
+            while offset + 4 <= len(extra):
+                kind, length = struct.unpack_from("<HH", extra, offset)
+                if kind == 0x0001 and length >= 16:
+                    file_size, compress_size = struct.unpack_from("<QQ", extra, offset + 4)
+                offset += 4 + length
+            # an entry that was still being streamed has its final sizes written over the header only once it's done
+            if file_size > 0 and compress_size == 0:
+                break
+            entry_end: int = end + 30 + name_length + extra_length + compress_size
+            if entry_end > size:
+                break
+            f.seek(entry_end)
+            if f.read(4) not in (b"PK\x03\x04", b"PK\x01\x02", b""):
+                break
+            info: ZipInfo = ZipInfo(name.decode("utf-8" if flags & 0x800 else "cp437"), ((dos_date >> 9) + 1980, (dos_date >> 5) & 0xF, dos_date & 0x1F, dos_time >> 11, (dos_time >> 5) & 0x3F, (dos_time & 0x1F) * 2))
+            info.flag_bits = flags
+            info.compress_type = method
+            info.CRC = crc
+            info.compress_size = compress_size
+            info.file_size = file_size
+            info.header_offset = end
+            recovered[info.filename] = info
+            end = entry_end
+    return recovered, end
+
+def clone_info(info: ZipInfo):
+    # every archive needs its own entry, since ZipFile records where it wrote it on the entry
+    clone: ZipInfo = ZipInfo.__new__(ZipInfo)
+    for attribute in ZipInfo.__slots__:
+        if hasattr(info, attribute):
+            setattr(clone, attribute, getattr(info, attribute))
+    return clone
+
+class ZipArchive:
+    def __init__(self, path: str, resume: bool=False):
+        self.path: str = path
+        # entries of an interrupted archive that can be kept, added back to the central directory as their files come up
+        self.recovered: dict = {}
+        if resume and os.path.exists(path):
+            self.recovered, end = recover_zip(path)
+            logger.info("Recovered %d entries from %s" %(len(self.recovered), path))
+            # ZipFile starts writing wherever a passed file is positioned and leaves what's before it alone
+            self.file = open(path, "r+b")
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            self.file = open(path, "wb")
+        self.zip: ZipFile = ZipFile(self.file, "w", ZIP_DEFLATED)
+
+    def keep(self, info: ZipInfo):
+        self.zip.filelist.append(info)
+        self.zip.NameToInfo[info.filename] = info
+
+    def add(self, info: ZipInfo, data, offset: int=0):
+        # the same steps as ZipFile.open(info, "w"), except the data is already compressed, starting at offset in data
+        zip64: bool = info.file_size > ZIP64_LIMIT or info.compress_size > ZIP64_LIMIT
+        self.zip.fp.seek(self.zip.start_dir)
+        info.header_offset = self.zip.fp.tell()
+        self.zip.fp.write(info.FileHeader(zip64))
+        data.seek(offset)
+        remaining: int = info.compress_size
+        while remaining > 0:
+            chunk: bytes = data.read(min(remaining, hash_chunk_size))
+            if len(chunk) == 0:
+                raise EOFError("compressed data for %s ends early" %info.filename)
+            self.zip.fp.write(chunk)
+            remaining -= len(chunk)
+        throttle.take(info.compress_size, 1 + info.compress_size // hash_chunk_size)
+        self.zip.start_dir = self.zip.fp.tell()
+        self.keep(info)
+
+    def close(self):
+        try:
+            self.zip.close()
+        finally:
+            self.file.close()
+
+class ZipStream:
+    def __init__(self, destinations: Destinations, archive_name: str, method: int=ZIP_DEFLATED, level: int=6, workers: int=1, store_extensions: tuple=(), resume: bool=False):
+        self.destinations: Destinations = destinations
+        self.root: str = destinations.roots[0]
+        # one archive per destination, all written from the same compressed data
+        self.archives: dict = {}
+        for root in destinations.roots:
+            try:
+                self.archives[root] = ZipArchive(root + "/" + archive_name, resume)
+            except OSError as e:
+                destinations.fail(root, e)
+        self.method: int = method
+        self.level: int = level
+        self.store_extensions: tuple = tuple(store_extensions)
+        self.workers: int = workers if workers > 0 else (os.cpu_count() or 1)
+        self.executor: ThreadPoolExecutor = None
+        if method != ZIP_STORED:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="compress")
+        # entries waiting on their compression thread, written to the archive in submission order
+        self.pending: deque = deque()
+        self.depth: int = self.workers * 2
+        # files made for the backup, like deltas, wait next to the archive until they're written into it. An interrupted run's are made again
+        self.scratch_files: set = set()
+        for root in destinations.roots:
+            rmtree(root + "/scratch.tmp", ignore_errors=True)
+
+    def arcname(self, destination: str):
+        return os.path.relpath(destination, self.root)
+
+    def live(self):
+        return [(root, self.archives[root]) for root in self.destinations.live()]
+
+    def fail(self, root: str, error: Exception):
+        close_quietly(self.archives[root].file)
+        self.destinations.fail(root, error)
+
+    def limit(self, workers: int=None):
+        # a source with its own workers setting gets at most that many files compressing at once
+        self.depth = workers if workers is not None else self.workers * 2
+
+    def begin_dir(self, destination: str):
+        pass
+
+    def can_link(self):
+        return False
 
-    os.chdir(working_dir)
-    write_toml(records, records_path)
-    logger.debug("Record file written to " + records_path)
-    backup_record["log_path"]: str = "%s/%s.log" %(destination_path, now)
-    
-    return backup_record
+    def end_dir(self, source: str, destination: str, keep: bool):
+        # written after the directory's contents so pruned directories never get an entry
+        if keep:
+            for root, archive in self.live():
+                try:
+                    archive.zip.write(source, self.arcname(destination))
+                except OSError as e:
+                    self.fail(root, e)
+
+    def resume(self, source: str, destination: str, st: os.stat_result):
+        infos: list = [(archive, archive.recovered.pop(self.arcname(destination), None)) for root, archive in self.live()]
+        # an entry only some archives finished is written to all of them again
+        if any(info is None or info.file_size != st.st_size for archive, info in infos):
+            return False
+        for archive, info in infos:
+            # the mode only lives in the central directory, which was never written
+            info.external_attr = (st.st_mode & 0xFFFF) << 16
+            archive.keep(info)
+        return True
 
-def differential_backup(conf: dict, compress=True):
-    working_dir: str = os.path.abspath(os.curdir)
-    now: str = datetime.datetime.now().strftime("%m-%d-%Y_%a_%H-%M-%S")
-    records: dict = toml.load(records_path)
-    logger.debug("Loaded records file at " + records_path)
-    destination_path: str = conf["destination"] + "Differential_" + now
+    def submit(self, source: str, destination: str, st: os.stat_result):
+        # build the entry from the walker's stat rather than letting ZipFile.write stat the file again
+        date_time: tuple = time.localtime(st.st_mtime)[:6]
+        if date_time[0] < 1980:
+            date_time = (1980, 1, 1, 0, 0, 0)
+        info: ZipInfo = ZipInfo(self.arcname(destination), date_time)
+        info.external_attr = (st.st_mode & 0xFFFF) << 16
+        info.file_size = st.st_size
+        # keep every thread busy without holding more than a couple of compressed files per thread
+        while len(self.pending) >= self.depth:
+            self.write(*self.pending.popleft())
+        if self.executor is None or st.st_size == 0 or source.lower().endswith(self.store_extensions):
+            self.pending.append((source, info, None))
+        elif st.st_size > compression_spool_size:
+            info.compress_type = self.method
+            self.pending.append((source, info, None))
+        else:
+            self.pending.append((source, info, self.executor.submit(compress_file, source, self.method, self.level)))
+
+    def scratch_path(self, destination: str):
+        root: str = self.destinations.live()[0]
+        path: str = "%s/scratch.tmp/%d" %(root, len(self.scratch_files))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.scratch_files.add(path)
+        return root, path
+
+    def submit_scratch(self, path: str, destination: str, st: os.stat_result):
+        self.submit(path, destination, st)
+
+    def write(self, source: str, info: ZipInfo, compressed):
+        start: float = time.perf_counter()
+        result = compressed.result() if compressed is not None else None
+        if compressed is None and info.compress_type != ZIP_STORED:
+            self.write_streamed(source, info)
+        elif result is None:
+            info.compress_type = ZIP_STORED
+            self.write_stored(source, info)
+        else:
+            data, info.CRC, info.file_size = result
+            with data:
+                info.compress_type = self.method
+                info.compress_size = data.tell()
+                info.flag_bits = 0x02 if self.method == ZIP_LZMA else 0x00
+                for root, archive in self.live():
+                    try:
+                        archive.add(clone_info(info), data)
+                    except OSError as e:
+                        self.fail(root, e)
+        if source in self.scratch_files:
+            os.remove(source)
+        elapsed: float = time.perf_counter() - start
+        metrics.add("archive", elapsed, 1, info.file_size)
+        if info.compress_type == ZIP_STORED:
+            metrics.count("stored")
+        if result is None:
+            metrics.file_time(source, elapsed, info.file_size)
+        logger.info("Backed up " + source)
+
+    def write_streamed(self, source: str, info: ZipInfo):
+        start: float = time.perf_counter()
+        with open(source, "rb") as src:
+            sample: bytes = src.read(compression_sample_size)
+            throttle.take(len(sample))
+        if len(sample) == compression_sample_size and len(zlib.compress(sample, 1)) > len(sample) * (1 - compression_min_saving):
+            info.compress_type = ZIP_STORED
+            self.write_stored(source, info)
+            return
+        info._compresslevel = self.level
+        # the first archive that takes the whole file compresses it, and the others copy its compressed bytes
+        for root, archive in self.live():
+            try:
+                with open(source, "rb") as src, archive.zip.open(info, "w") as dst:
+                    copy_stream(src, dst)
+                archive.file.flush()
+                break
+            except OSError as e:
+                if e.filename == source:
+                    raise
+                self.fail(root, e)
+        metrics.add("compress", time.perf_counter() - start, 1, info.file_size)
+        data_start: int = archive.zip.start_dir - info.compress_size
+        with open(archive.path, "rb") as data:
+            for other_root, other in self.live():
+                if other is archive:
+                    continue
+                try:
+                    other.add(clone_info(info), data, data_start)
+                except OSError as e:
+                    self.fail(other_root, e)
+
+    def write_stored(self, source: str, info: ZipInfo):
+        if len(self.archives) == 1:
+            root, archive = self.live()[0]
+            with open(source, "rb") as src, archive.zip.open(info, "w") as dst:
+                copy_stream(src, dst)
+            return
+        # one read of the source feeds every archive
+        outputs: list = []
+        for root, archive in self.live():
+            try:
+                outputs.append((root, archive.zip.open(clone_info(info), "w")))
+            except OSError as e:
+                self.fail(root, e)
+        with open(source, "rb") as src:
+            while len(outputs) > 0:
+                chunk: bytes = src.read(hash_chunk_size)
+                if len(chunk) == 0:
+                    break
+                throttle.take(len(chunk) * (len(outputs) + 1), len(outputs) + 1)
+                for output in list(outputs):
+                    try:
+                        output[1].write(chunk)
+                    except OSError as e:
+                        outputs.remove(output)
+                        self.fail(output[0], e)
+        for root, dst in outputs:
+            try:
+                dst.close()
+            except OSError as e:
+                self.fail(root, e)
+
+    def join(self):
+        try:
+            while len(self.pending) > 0:
+                self.write(*self.pending.popleft())
+        finally:
+            # every write already counted its own time, so only finishing the archives is added here
+            start: float = time.perf_counter()
+            if self.executor is not None:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+            for root, archive in self.live():
+                try:
+                    archive.close()
+                except OSError as e:
+                    self.fail(root, e)
+            metrics.add("archive", time.perf_counter() - start)
+            for root in self.destinations.roots:
+                rmtree(root + "/scratch.tmp", ignore_errors=True)
+
+def find_chunk_end(data: bytearray):
+    # nothing before the minimum size can be a cut, so the search starts there
+    end: int = min(len(data), chunk_max_size)
+    if end <= chunk_min_size:
+        return end
+    start: int = chunk_min_size - len(chunk_anchor)
+    found: int = data[start:end].translate(chunk_classes).find(chunk_anchor)
+    if found == -1:
+        return end
+    return start + found + len(chunk_anchor)
+
+def chunk_path(chunks_dir: str, digest: str):
+    return "%s/%s/%s" %(chunks_dir, digest[:2], digest)
+
+def store_chunks(source: str, chunks_dirs: list, level):
+    # runs in a worker process; returns the file's chunk list, how much of it was new, and the chunk directories that couldn't be written to
+    start: float = time.perf_counter()
+    chunks: list = []
+    size: int = 0
+    written: int = 0
+    written_size: int = 0
+    failed: dict = {}
+    data: bytearray = bytearray()
+    with open(source, "rb") as src:
+        eof: bool = False
+        while not eof or len(data) > 0:
+            if not eof and len(data) < chunk_max_size:
+                block: bytes = src.read(chunk_max_size)
+                throttle.take(len(block))
+                eof = len(block) == 0
+                data += block
+                continue
+            end: int = find_chunk_end(data)
+            chunk: bytes = bytes(data[:end])
+            del data[:end]
+            size += len(chunk)
+            digest: str = hashlib.blake2b(chunk, digest_size=32).hexdigest()
+            chunks.append(digest)
+            stored: bytes = None
+            for chunks_dir in chunks_dirs:
+                path: str = chunk_path(chunks_dir, digest)
+                if chunks_dir in failed.keys() or os.path.exists(path):
+                    continue
+                if stored is None:
+                    # one leading byte says whether the rest is zlib compressed
+                    stored = b"\x00" + chunk
+                    if level is not None:
+                        compressed: bytes = zlib.compress(chunk, level)
+                        if len(compressed) < len(chunk):
+                            stored = b"\x01" + compressed
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    # another process may be writing the same chunk; whichever rename lands last wins with identical contents
+                    tmp_path: str = "%s.%d.tmp" %(path, os.getpid())
+                    with open(tmp_path, "wb") as f:
+                        f.write(stored)
+                    throttle.take(len(stored))
+                    os.replace(tmp_path, path)
+                except OSError as e:
+                    failed[chunks_dir] = str(e)
+                    continue
+                written += 1
+                written_size += len(stored)
+    return chunks, size, written, written_size, time.perf_counter() - start, failed
+
+def read_chunk(chunks_dir: str, digest: str):
+    with open(chunk_path(chunks_dir, digest), "rb") as f:
+        stored: bytes = f.read()
+    if stored[:1] == b"\x01":
+        return zlib.decompress(stored[1:])
+    return stored[1:]
+
+def read_index(path: str):
+    with gzip.open(path, "rt") as f:
+        for line in f:
+            yield json.loads(line)
+
+class RepositoryWriter:
+    def __init__(self, conf: dict, destinations: Destinations, previous_indexes: dict=None):
+        self.destinations: Destinations = destinations
+        self.root: str = destinations.roots[0]
+        # each destination has its own repository next to its backup folders
+        self.chunks_dirs: dict = {root: os.path.dirname(root) + "/chunks" for root in destinations.roots}
+        self.level = None if conf["compression"] == "store" else conf["compression-level"]
+        self.store_extensions: tuple = tuple(conf["store-extensions"])
+        self.workers: int = conf["compression-workers"] if conf["compression-workers"] > 0 else (os.cpu_count() or 1)
+        self.executor: ProcessPoolExecutor = None
+        if self.workers > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=(throttle.overall,))
+        # chunk lists of the backup the records describe, reused for files the records say are unchanged.
+        # Every destination got the same backup, so one index serves them all, but only destinations that have it can reuse its chunks
+        self.previous: dict = {}
+        self.linkable: set = set((previous_indexes or {}).keys())
+        self.linked_from: str = None
+        if len(self.linkable) > 0:
+            self.linked_from = list(previous_indexes.values())[0]
+            for record in read_index(self.linked_from):
+                if not record["dir"]:
+                    self.previous[record["path"]] = (record["size"], record["chunks"])
+        self.indexes: dict = {}
+        for root in destinations.roots:
+            try:
+                os.makedirs(self.chunks_dirs[root], exist_ok=True)
+                self.indexes[root] = gzip.open(root + "/index.jsonl.gz", "wt", compresslevel=6)
+            except OSError as e:
+                destinations.fail(root, e)
+        self.pending: deque = deque()
+        self.depth: int = self.workers * 2
+
+    def arcname(self, destination: str):
+        return os.path.relpath(destination, self.root)
+
+    def limit(self, workers: int=None):
+        self.depth = workers if workers is not None else self.workers * 2
+
+    def begin_dir(self, destination: str):
+        pass
+
+    def can_link(self):
+        # every index lists every file, so unchanged files are always linked from the previous one or chunked again
+        return True
+
+    def resume(self, source: str, destination: str, st: os.stat_result):
+        # the index is written from scratch; chunks that were already stored are found by hash and not written again
+        return False
+
+    def end_dir(self, source: str, destination: str, keep: bool):
+        # directories are listed even when nothing in them changed, like the files
+        st: os.stat_result = os.stat(source)
+        self.write_record({"path": self.arcname(destination), "dir": True, "mode": st.st_mode & 0o7777, "mtime": st.st_mtime_ns})
+
+    def write_record(self, record: dict):
+        line: str = json.dumps(record, separators=(",", ":")) + "\n"
+        for root in self.destinations.live():
+            try:
+                self.indexes[root].write(line)
+            except OSError as e:
+                close_quietly(self.indexes[root])
+                self.destinations.fail(root, e)
+
+    def submit(self, source: str, destination: str, st: os.stat_result):
+        level = None if source.lower().endswith(self.store_extensions) else self.level
+        while len(self.pending) >= self.depth:
+            self.write(*self.pending.popleft())
+        chunks_dirs: list = [self.chunks_dirs[root] for root in self.destinations.live()]
+        if self.executor is None:
+            result: tuple = store_chunks(source, chunks_dirs, level)
+        else:
+            result = self.executor.submit(store_chunks, source, chunks_dirs, level)
+        self.pending.append((source, self.arcname(destination), st, result))
+
+    def link(self, source: str, destination: str, st: os.stat_result):
+        previous: tuple = self.previous.get(self.arcname(destination))
+        if previous is None or previous[0] != st.st_size or not self.linkable.issuperset(self.destinations.live()):
+            self.submit(source, destination, st)
+            return
+        self.write_record({"path": self.arcname(destination), "dir": False, "mode": st.st_mode & 0o7777, "mtime": st.st_mtime_ns, "size": st.st_size, "chunks": previous[1]})
+        metrics.add("link", 0, 1, st.st_size)
+        metrics.count("chunks_reused", len(previous[1]))
+        logger.debug("Reused the chunks of %s from %s" %(source, self.linked_from))
+
+    def write(self, source: str, arcname: str, st: os.stat_result, result):
+        if not isinstance(result, tuple):
+            result = result.result()
+        chunks, size, written, written_size, elapsed, failed = result
+        for root, chunks_dir in self.chunks_dirs.items():
+            if chunks_dir in failed.keys():
+                close_quietly(self.indexes[root])
+                self.destinations.fail(root, OSError(failed[chunks_dir]))
+        self.write_record({"path": arcname, "dir": False, "mode": st.st_mode & 0o7777, "mtime": st.st_mtime_ns, "size": size, "chunks": chunks})
+        metrics.add("chunk", elapsed, 1, size)
+        metrics.file_time(source, elapsed, size)
+        metrics.count("chunks_written", written)
+        metrics.count("chunks_reused", len(chunks) * len(self.destinations.live()) - written)
+        metrics.count("chunk_bytes_written", written_size)
+        logger.info("Backed up " + source)
+
+    def join(self):
+        try:
+            while len(self.pending) > 0:
+                self.write(*self.pending.popleft())
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+            for root in self.destinations.live():
+                try:
+                    self.indexes[root].close()
+                except OSError as e:
+                    self.destinations.fail(root, e)
+
+def on_destination(path: str, root: str):
+    # records keep paths into the destination a backup was first written to; the same backup sits at the same place in every destination
+    parts: list = path.split("/")
+    for i in range(len(parts) - 1, -1, -1):
+        if re.search(backup_name_pattern, parts[i]) is not None:
+            return os.path.dirname(root) + "/" + "/".join(parts[i:])
+    return path
+
+def snapshot_copier(conf: dict, records, destinations: Destinations):
+    if not conf["hardlink-snapshots"]:
+        return CopyPool(conf["workers"], destinations)
+    snapshot: str = records.meta.get("snapshot")
+    link_from: dict = {}
+    if snapshot is not None:
+        for root in destinations.roots:
+            if os.path.isdir(on_destination(snapshot, root)):
+                link_from[root] = on_destination(snapshot, root)
+    if len(link_from) == 0:
+        logger.info("No previous snapshot to hardlink from; copying every file")
+    for root, previous in link_from.items():
+        logger.info("Hardlinking unchanged files from " + previous)
+    return CopyPool(conf["workers"], destinations, link_from)
+
+def block_signature(f, block_size: int):
+    # a cheap adler32 to rule blocks out and a blake2b to confirm a match, for every block of the file
+    weak: list = []
+    strong: list = []
+    while True:
+        block: bytes = f.read(block_size)
+        if len(block) == 0:
+            break
+        throttle.take(len(block))
+        weak.append(zlib.adler32(block))
+        strong.append(hashlib.blake2b(block, digest_size=16).hexdigest())
+    return weak, strong
+
+def make_delta(source: str, signature: dict, base: str, path: str, limit: int):
+    # writes the blocks of source that aren't anywhere in the signed copy to path, and returns their size.
+    # Returns None without writing anything once more than limit bytes have changed
+    block_size: int = signature["block_size"]
+    blocks: dict = {}
+    for index, weak in enumerate(signature["weak"]):
+        blocks.setdefault(weak, []).append(index)
+    # [offset in the base, length] for runs copied from the base, [-1, length] for runs stored in the delta
+    runs: list = []
+    size: int = 0
+    changed: int = 0
+    with open(source, "rb") as src, SpooledTemporaryFile(max_size=hash_chunk_size, dir=os.path.dirname(path)) as data:
+        while True:
+            block: bytes = src.read(block_size)
+            if len(block) == 0:
+                break
+            throttle.take(len(block))
+            offset: int = -1
+            strong: str = None
+            for index in blocks.get(zlib.adler32(block), ()):
+                if strong is None:
+                    strong = hashlib.blake2b(block, digest_size=16).hexdigest()
+                if signature["strong"][index] == strong:
+                    offset = index * block_size
+                    break
+            if offset < 0:
+                changed += len(block)
+                if changed > limit:
+                    return None
+                data.write(block)
+            if len(runs) > 0 and (runs[-1][0] < 0) == (offset < 0) and (offset < 0 or runs[-1][0] + runs[-1][1] == offset):
+                runs[-1][1] += len(block)
+            else:
+                runs.append([offset, len(block)])
+            size += len(block)
+        data.seek(0)
+        with open(path, "wb") as f:
+            f.write(delta_magic)
+            f.write(json.dumps({"base": base, "size": size, "runs": runs}, separators=(",", ":")).encode() + b"\n")
+            copyfileobj(data, f)
+    return changed
+
+class DeltaStore:
+    # full backups sign their copies of large files; differentials and incrementals then store those files as deltas against them
+    def __init__(self, conf: dict, destinations: Destinations, backup_type: int, base: str=None):
+        self.destinations: Destinations = destinations
+        self.root: str = destinations.roots[0]
+        self.type: int = backup_type
+        self.min_size: int = conf["delta-min-size"] * 1024 * 1024
+        self.block_size: int = conf["delta-block-size"] * 1024
+        self.workers: int = conf["workers"]
+        self.base: str = base
+        self.signatures: dict = {}
+        self.stored: list = []
+        if backup_type == 0 or base is None:
+            return
+        # every destination got the same full backup, so the first one that has its signatures serves them all
+        for root in destinations.live():
+            path: str = os.path.dirname(root) + "/" + base + "/signatures.jsonl.gz"
+            if os.path.exists(path):
+                for signature in read_index(path):
+                    self.signatures[signature["path"]] = signature
+                break
+        if len(self.signatures) > 0:
+            logger.info("Storing changed files of %s or more as deltas against %s" %(hr_size(self.min_size), base))
+
+    def submit(self, copier, entry: Entry, destination: str):
+        arcname: str = destination[len(self.root) + 1:]
+        signature: dict = self.signatures.get(arcname)
+        if signature is None:
+            return False
+        start: float = time.perf_counter()
+        # written on the destination, where the copier picks it up
+        root, path = copier.scratch_path(destination)
+        try:
+            changed: int = make_delta(entry.path, signature, self.base, path, int(entry.stat.st_size * delta_max_changed))
+        except OSError as e:
+            if e.filename == entry.path:
+                raise
+            self.destinations.fail(root, e)
+            return False
+        if changed is None:
+            logger.debug("Too much of %s changed for a delta; storing all of it" %entry.path)
+            return False
+        # the delta stands in for the file, so it carries the file's mode and mtime into the backup
+        os.chmod(path, entry.stat.st_mode & 0o7777)
+        os.utime(path, ns=(entry.stat.st_atime_ns, entry.stat.st_mtime_ns))
+        metrics.add("delta", time.perf_counter() - start, 1, entry.stat.st_size)
+        metrics.count("deltas")
+        metrics.count("delta_bytes_saved", entry.stat.st_size - changed)
+        logger.debug("%s changed in %s of %s" %(entry.path, hr_size(changed), hr_size(entry.stat.st_size)))
+        self.stored.append(arcname)
+        copier.submit_scratch(path, destination, os.stat(path))
+        return True
+
+    def sign(self, arcname: str, archive: str, opened: list, signatures: list):
+        try:
+            if archive is not None:
+                f = zip_handle(archive, opened).open(arcname)
+            else:
+                f = open(self.destinations.live()[0] + "/" + arcname, "rb")
+            with f:
+                weak, strong = block_signature(f, self.block_size)
+        # a file without a signature is only stored whole by later backups
+        except Exception as e:
+            logger.warning("Could not record block checksums of %s: %s" %(arcname, str(e)))
+            return
+        signatures.append({"path": arcname, "block_size": self.block_size, "weak": weak, "strong": strong})
+
+    def finish(self, contents, archive: str=None):
+        # runs once the copies are done. A full backup signs the large files as they were stored, so deltas are always taken against
+        # exactly what a restore will read back, and a differential lists which of its files are deltas
+        if self.type == 0:
+            start: float = time.perf_counter()
+            signatures: list = []
+            opened: list = []
+            signer: CopyPool = CopyPool(self.workers)
+            if archive is not None:
+                archive = self.destinations.live()[0] + "/" + archive
+            contents.seek(0)
+            for line in contents:
+                expected: dict = json.loads(line)
+                if expected["size"] >= self.min_size:
+                    signer.run(self.sign, expected["path"], archive, opened, signatures)
+            signer.join()
+            for handle in opened:
+                handle.close()
+            restore_handles.handles = None
+            if len(signatures) == 0:
+                return
+            metrics.add("sign", time.perf_counter() - start, len(signatures))
+            logger.info("Recorded block checksums of %d large files for later deltas" %len(signatures))
+            for root in self.destinations.live():
+                try:
+                    with gzip.open(root + "/signatures.jsonl.gz", "wt", compresslevel=6) as f:
+                        for signature in signatures:
+                            f.write(json.dumps(signature, separators=(",", ":")) + "\n")
+                except OSError as e:
+                    self.destinations.fail(root, e)
+            return
+        if len(self.stored) == 0:
+            return
+        logger.info("%d large files were stored as deltas against %s" %(len(self.stored), self.base))
+        # without the list a restore would hand back the delta itself, so a destination that can't have it fails
+        for root in self.destinations.live():
+            try:
+                with open(root + "/deltas.txt", "w") as f:
+                    for arcname in self.stored:
+                        f.write(arcname + "\n")
+            except OSError as e:
+                self.destinations.fail(root, e)
+
+def write_manifest(destination_path: str, manifest: dict):
+    write_toml(manifest, destination_path + "/manifest.toml")
+
+def read_manifest(backup_path: str):
+    path: str = backup_path + "/manifest.toml"
+    if not os.path.exists(path):
+        return None
+    return toml.load(path)
+
+def run_backup(conf: dict, backup_type: int, compress=True, rehash_all=False, resume: str=None):
+    name: str = backup_types[backup_type]
+    if resume is not None:
+        now: str = resume.split("_", 1)[1]
+    else:
+        now: str = datetime.datetime.now().strftime("%m-%d-%Y_%a_%H-%M-%S")
+    destinations: Destinations = Destinations([destination + name + "_" + now for destination in conf["destinations"]])
+    destination_of: dict = dict(zip(destinations.roots, conf["destinations"]))
+    destination_path: str = conf["destination"] + name + "_" + now
+
+    # full backups compare against nothing and only use the base records as a hash cache,
+    # differentials compare against the last full, incrementals against the last backup of any kind
+    base = open_records(conf, peek=backup_type == 0 and rehash_all and not conf["hardlink-snapshots"] and not conf["repository"])
+    head = open_records(conf, peek=backup_type != 3, head=True)
+    if backup_type == 0:
+        records = base
+        updates = base.rewrite(conf["hash-algorithm"])
+    elif backup_type == 1:
+        records = base
+        updates = base
+    else:
+        if head.algorithm == conf["hash-algorithm"]:
+            records = head
+        else:
+            logger.warning("No records of the last backup found; comparing against the last full backup instead")
+            records = base
+        updates = None
+    # the journal only says what changed since the backup the records describe, so it can't build complete snapshots
+    journaled: dict = {}
+    if conf["journal"] and backup_type != 0 and not conf["repository"] and not (conf["hardlink-snapshots"] and not compress) and head.algorithm == conf["hash-algorithm"] and records.meta.get("backup") is not None:
+        journaled = journal_changes(conf, backup_timestamp(records.meta["backup"]))
+    if len(journaled) > 0 and isinstance(head, TomlRecords) and backup_type != 3:
+        head = open_records(conf, head=True)
+    # files the journal skips keep their head records
+    head_updates = head.rewrite(conf["hash-algorithm"], keep=len(journaled) > 0)
+    parent: str = records.meta.get("backup") if backup_type != 0 else None
+    logger.debug("Comparing against records at %s" %records.path)
 
     backup_record: dict = {}
     backup_record["total_filesize"]: int = 0
     backup_record["total_files"]: int = 0
     backup_record["total_directories"]: int = 0
+    backup_record["linked_files"]: int = 0
 
-    try:
-        logger.info("Creating destination path at " + destination_path)
-        os.makedirs(destination_path)
-    except FileExistsError:
-        if confirm("The destination folder already exists at %s. Remove?" %destination_path, False, True): 
-            logger.debug("User chose to remove the existing directory at destination path")
-            rmtree(destination_path)
-            os.makedirs(destination_path)
-        else:
-            logger.critical("User chose to leave the existing directory")
-            exit(1)
-
+    for root in destinations.roots:
+        try:
+            if resume is not None:
+                # a destination that missed the interrupted run gets everything
+                os.makedirs(root, exist_ok=True)
+                continue
+            logger.info("Creating destination path at " + root)
+            os.makedirs(root)
+        except FileExistsError:
+            logger.warning("Destination path already exists")
+            if confirm("The destination folder already exists at %s. Remove?" %root, False, True): 
+                logger.debug("User chose to remove the existing directory at destination path")
+                rmtree(root)
+                os.makedirs(root)
+            else:
+                logger.critical("User chose to leave the existing directory")
+                write_log()
+                exit(1)
+        except OSError as e:
+            destinations.fail(root, e)
+    if parent is not None:
+        for root in destinations.live():
+            if parent not in [entry["name"] for entry in load_catalog(destination_conf(conf, destination_of[root]))]:
+                logger.warning("%s has no copy of %s, which this backup builds on. Run a full backup to complete it there" %(destination_of[root], parent))
+
+    # the hashes of every file handled so far, so an interrupted run can be resumed without redoing them.
+    # Kept in the first destination that's working, or wherever the interrupted run kept it
+    checkpoint_path: str = destinations.live()[0] + "/checkpoint.db"
+    if resume is not None:
+        checkpoint_path = find_checkpoint(conf, resume) or checkpoint_path
+    cache = None
+    if resume is not None:
+        checkpoint: SqliteRecords = SqliteRecords(checkpoint_path)
+        logger.info("Resuming %s, which stopped while %s" %(resume, checkpoint.meta.get("phase", "starting")))
+        if checkpoint.algorithm == conf["hash-algorithm"]:
+            cache = checkpoint
+    else:
+        checkpoint: SqliteRecords = SqliteRecords(checkpoint_path, conf["hash-algorithm"])
+
+    hasher: HashPool = HashPool(conf["hash-algorithm"], conf["hash-workers"], rehash_all)
+    if conf["repository"]:
+        compress = False
+        previous_index: str = records.meta.get("index")
+        previous_indexes: dict = {}
+        if previous_index is not None:
+            for root in destinations.live():
+                if os.path.exists(on_destination(previous_index, root)):
+                    previous_indexes[root] = on_destination(previous_index, root)
+        for root in destinations.live():
+            logger.info("Storing chunks in " + repository_path(destination_conf(conf, destination_of[root])))
+        copier = RepositoryWriter(conf, destinations, previous_indexes)
+    elif compress:
+        archive_name: str = name + "_" + now + ".zip"
+        for root in destinations.live():
+            logger.info("Archiving into %s/%s" %(root, archive_name))
+        copier = ZipStream(destinations, archive_name, compression_methods[conf["compression"]], conf["compression-level"], conf["compression-workers"], conf["store-extensions"], resume is not None)
+    else:
+        copier = snapshot_copier(conf, records, destinations)
+    # hardlink snapshots have to be complete files, and repositories already only store the chunks that changed
+    deltas: DeltaStore = None
+    if conf["delta-min-size"] > 0 and not conf["repository"] and not (conf["hardlink-snapshots"] and not compress):
+        deltas = DeltaStore(conf, destinations, backup_type, base.meta.get("backup") if backup_type != 0 else None)
+    checkpoint.meta.update({"type": backup_type, "compressed": int(compress), "phase": "backing up files"})
+    checkpoint.commit()
+    # every file in the backup with its size and hash, spooled until the copies are done and then written next to each copy
+    contents_file = SpooledTemporaryFile(max_size=hash_chunk_size, mode="w+")
+    job: dict = {"type": backup_type, "records": records, "updates": updates, "head": head_updates, "hasher": hasher, "copier": copier,
+        "checkpoint": checkpoint, "cache": cache, "resuming": resume is not None, "lookup": None, "root": destinations.roots[0], "contents": contents_file, "deltas": deltas, "flushed": time.monotonic()}
+
+    # files that were in the compared backup but aren't any more, so a restore can leave them out
+    deleted_file = SpooledTemporaryFile(max_size=hash_chunk_size, mode="w+")
+    deleted_count: int = 0
     for path in conf["source-directories"]:
+        options: dict = conf["source-options"].get(os.path.abspath(path), {})
+        if len(options) > 0:
+            logger.info("Backing up %s with %s" %(path, ", ".join("%s = %s" %(key, str(value).lower() if isinstance(value, bool) else value) for key, value in options.items())))
+        throttle.limit_source(options.get("bandwidth-limit", 0), options.get("iops-limit", 0))
+        copier.limit(options.get("workers"))
+        idle: bool = options.get("low-priority", False) and not conf["low-priority"]
+        if idle:
+            set_io_class(IOPRIO_CLASS_IDLE)
         logger.info("Creating destination directory for " + path)
-        os.makedirs(destination_path + "/" + item_from_path(path))
-        logger.debug("Destination created. Backing up " + path)
-        dir_record: dict = backup_dir(False, path, destination_path + "/" + item_from_path(path), records, conf["use-md5"])
+        copier.begin_dir(destination_path + "/" + item_from_path(path))
+
+        source: str = os.path.abspath(path)
+        def deleted(deleted_path: str, source: str=source, arcname: str=item_from_path(path)):
+            nonlocal deleted_count
+            logger.debug("Deleted since the last backup: " + deleted_path)
+            deleted_file.write(arcname + deleted_path[len(source):] + "\n")
+            deleted_count += 1
+        if source in journaled.keys():
+            changed: list = journaled[source]
+            logger.info("Destination created. Backing up %d changed paths in %s from the change journal" %(len(changed), path))
+            dir_record: dict = backup_changed(job, source, os.path.abspath(destination_path + "/" + item_from_path(path)), changed, deleted)
+        else:
+            if conf["journal"] and backup_type != 0:
+                logger.info("The change journal doesn't cover %s since the last backup; walking it" %path)
+            logger.info("Destination created. Backing up " + path)
+            job["lookup"] = MergedRecords(records, source, deleted)
+            dir_record: dict = backup_dir(job, source, os.path.abspath(destination_path + "/" + item_from_path(path)))
+            job["lookup"].finish()
+        copier.end_dir(path, destination_path + "/" + item_from_path(path), True)
+        if idle:
+            set_io_class(IOPRIO_CLASS_BE)
 
         backup_record["total_filesize"] += dir_record["total_filesize"]
         backup_record["total_files"] += dir_record["total_files"]
         backup_record["total_directories"] += dir_record["total_directories"]
-
-    os.chdir(destination_path)
+        backup_record["linked_files"] += dir_record["linked_files"]
+    metrics.count("deleted", deleted_count)
+    checkpoint.meta["phase"] = "finishing the copies" if not compress else "finishing the archive"
+    checkpoint.commit()
+    copier.join()
+    hasher.close()
+    if deltas is not None:
+        deltas.finish(contents_file, archive_name if compress else None)
+    if deleted_count > 0:
+        logger.info("%d files were deleted since the last backup" %deleted_count)
+    with deleted_file, contents_file:
+        for root in destinations.live():
+            try:
+                if deleted_count > 0:
+                    deleted_file.seek(0)
+                    with open(root + "/deleted.txt", "w") as f:
+                        copyfileobj(deleted_file, f)
+                contents_file.seek(0)
+                with gzip.open(root + "/contents.jsonl.gz", "wt", compresslevel=6) as f:
+                    copyfileobj(contents_file, f)
+            except OSError as e:
+                destinations.fail(root, e)
+
+    items: int = backup_record["total_directories"] + backup_record["total_files"]
     if compress:
-        try:
-            logger.info("Finished copying source directories. Archiving")
-            make_archive("Differential_" + now, "zip", destination_path)
-        except ValueError as e:
-            logger.error("Error occured during creation of archive: " + str(e))
-
-        logger.info("Archive created. Removing working files")
-        for file in os.listdir(destination_path):
-            if os.path.isdir(file):
-                logger.debug("Removing " + file)
-                rmtree(destination_path + "/" + file)
-
-        with ZipFile("Differential_" + now + ".zip") as z:
-            logger.info("Differential backup completed. Backed up %d items with a compressed size of %s." %(len(z.infolist()), item_size(destination_path + "/Differential_" + now + ".zip")))
-        os.chdir(working_dir)
+        logger.info("%s backup completed. Backed up %d items with a compressed size of %s" %(name, items, item_size(destinations.live()[0] + "/" + archive_name)))
     else:
-        items: int = backup_record["total_files"] + backup_record["total_directories"]
-        logger.info("Differential backup completed. Backed up %d items with a total size of %d" %(items, hr_size(backup_record["total_filesize"])))
-
-    backup_record["log_path"]: str = "%s/%s.log" %(destination_path, now)
+        logger.info("%s backup completed. Backed up %d items with a total size of %s" %(name, items, hr_size(backup_record["total_filesize"])))
+    if conf["repository"]:
+        logger.info("%d unchanged files reused their chunks from the previous backup" %backup_record["linked_files"])
+    elif backup_record["linked_files"] > 0:
+        logger.info("%d unchanged files were hardlinked from %s" %(backup_record["linked_files"], records.meta["snapshot"]))
+
+    manifest: dict = {"type": name, "name": name + "_" + now, "created": now, "compressed": compress}
+    if conf["repository"]:
+        manifest["repository"] = True
+    if parent is not None:
+        manifest["parent"] = parent
+    manifest["total_files"] = backup_record["total_files"]
+    manifest["total_filesize"] = backup_record["total_filesize"]
+    manifest["deleted_files"] = deleted_count
+    manifest["hash_algorithm"] = conf["hash-algorithm"]
+    for root in destinations.live():
+        try:
+            write_manifest(root, manifest)
+            view: dict = destination_conf(conf, destination_of[root])
+            add_to_catalog(view, catalog_entry(view, name + "_" + now, manifest))
+        except OSError as e:
+            destinations.fail(root, e)
+    completed: list = destinations.live()
+    if len(destinations.failed) > 0:
+        logger.error("%s backup failed on %d of %d destinations: %s" %(name, len(destinations.failed), len(destinations.roots), ", ".join(destinations.failed.keys())))
+        # a half written backup would only be mistaken for a real one when the catalog is rebuilt
+        for root in destinations.failed.keys():
+            rmtree(root, ignore_errors=True)
+
+    # later backups hardlink their unchanged files from this one if it's a complete snapshot
+    snapshot: bool = not compress and not conf["repository"] and (backup_type == 0 or copier.can_link())
+    index: str = completed[0] + "/index.jsonl.gz" if conf["repository"] else None
+    if backup_type == 0:
+        updates.meta["backup"] = name + "_" + now
+        if snapshot:
+            updates.meta["snapshot"] = completed[0]
+        if index is not None:
+            updates.meta["index"] = index
+    head_updates.meta["backup"] = name + "_" + now
+    if snapshot:
+        head_updates.meta["snapshot"] = completed[0]
+    if index is not None:
+        head_updates.meta["index"] = index
+    # a differential only writes back unchanged files whose metadata moved on, so they aren't rehashed next time
+    start: float = time.perf_counter()
+    if updates is not None:
+        updates.commit()
+    head_updates.commit()
+    base.close()
+    head.close()
+    metrics.add("records", time.perf_counter() - start)
+    logger.debug("Record files written to %s and %s" %(base.path, head.path))
+    if conf["journal"] and backup_type == 0:
+        prune_journal(backup_timestamp(name + "_" + now))
+    checkpoint.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(checkpoint_path + suffix):
+            os.remove(checkpoint_path + suffix)
+
+    backup_record["name"]: str = name + "_" + now
+    backup_record["type"]: str = name
+    backup_record["path"]: str = completed[0]
+    backup_record["paths"]: list = completed
+    backup_record["failed"]: list = list(destinations.failed.keys())
+    backup_record["log_path"]: str = "%s/%s.log" %(completed[0], now)
     return backup_record
-    
-def backup_dir(full_backup: bool, path: str, destination: str, records: dict, use_md5: bool):
-    previous_path: str = os.path.abspath(os.curdir)
-    os.chdir(path)
 
+def walk_order(entry: Entry):
+    # "a/" sorts after "a.txt" and "a-b", just like "a/x" does as part of a full path
+    return entry.name + "/" if entry.is_dir else entry.name
+
+class MergedRecords:
+    # looks records up by stepping through them in sorted order alongside the sorted walk, so memory doesn't grow
+    # with the number of records. Records the walk steps past belong to files that are gone
+    def __init__(self, records, source: str, deleted):
+        self.rows = records.sorted_items(source)
+        self.current: tuple = next(self.rows, None)
+        self.deleted = deleted
+
+    def get(self, path: str):
+        while self.current is not None and self.current[0] < path:
+            self.deleted(self.current[0])
+            self.current = next(self.rows, None)
+        if self.current is not None and self.current[0] == path:
+            record = self.current[1]
+            self.current = next(self.rows, None)
+            return record
+        return None
+
+    def finish(self):
+        while self.current is not None:
+            self.deleted(self.current[0])
+            self.current = next(self.rows, None)
+
+def update_records(job: dict, entry: Entry, record: dict, compare: str, rehashed: bool):
+    changed: bool = record is None or record_hash(record) != compare
+    current: dict = {"hash": compare, "stat": record_stat(entry.stat)}
+    if job["type"] == 0:
+        job["updates"].put(entry.path, current)
+        logger.debug("Updated %s in records: %s" %(entry.path, compare))
+    elif not changed and rehashed and job["hasher"].algorithm != "mtime" and job["updates"] is not None:
+        logger.debug("%s was touched but its contents are unchanged" %entry.path)
+        job["updates"].put(entry.path, current)
+    job["head"].put(entry.path, current)
+    job["checkpoint"].put(entry.path, current)
+    if time.monotonic() - job["flushed"] >= checkpoint_interval:
+        job["checkpoint"].flush()
+        job["flushed"] = time.monotonic()
+    return changed
+
+def finished_before(job: dict, entry: Entry):
+    # what the interrupted run wrote can only be kept if the file hasn't changed since that run recorded it;
+    # a copy or entry of the right size could still hold contents from before a rewrite
+    if not job["resuming"] or job["cache"] is None:
+        return False
+    record = job["cache"].get(entry.path)
+    return isinstance(record, dict) and record["stat"] == record_stat(entry.stat)
+
+def expect(job: dict, entry: Entry, target: str, compare: str):
+    # what verify checks the backup against later; content hashes are only known when the records keep them
+    expected: dict = {"path": target[len(job["root"]) + 1:], "size": entry.stat.st_size}
+    if job["hasher"].algorithm != "mtime":
+        expected["hash"] = compare
+    job["contents"].write(json.dumps(expected, separators=(",", ":")) + "\n")
+
+def store(job: dict, entry: Entry, target: str):
+    deltas: DeltaStore = job["deltas"]
+    if deltas is not None and job["type"] != 0 and entry.stat.st_size >= deltas.min_size and deltas.submit(job["copier"], entry, target):
+        return
+    job["copier"].submit(entry.path, target, entry.stat)
+
+def dir_record():
+    return {"total_filesize": 0, "total_files": 0, "total_directories": 0, "linked_files": 0, "linked_filesize": 0}
+
+def walk_steps(job: dict, path: str, destination: str, rel: str=""):
+    # the walk as the copies take it: each directory's files in runs between its subdirectories, looked up in walk order
+    # so the records are read in the same order, with every subdirectory between an "enter" and a "leave"
+    start: float = time.perf_counter()
+    # sorted so that full paths come out in the same order as the records are stored
+    entries: list = sorted(scan_dir(path, rel), key=walk_order)
+    metrics.add("scan", time.perf_counter() - start, sum(1 for entry in entries if not entry.is_dir))
+    for is_dir, group in groupby(entries, key=lambda entry: entry.is_dir):
+        if is_dir:
+            for entry in group:
+                item_destination_path: str = destination + "/" + entry.name
+                yield "enter", entry, item_destination_path
+                yield from walk_steps(job, entry.path, item_destination_path, entry.rel)
+                yield "leave", entry, item_destination_path
+            continue
+        files: list = list(group)
+        logger.debug("Checking %d files in %s using %s" %(len(files), path, job["hasher"].algorithm))
+        yield "files", job["hasher"].lookup(files, job["lookup"], job["cache"]), destination
+
+def backup_dir(job: dict, path: str, destination: str):
+    hasher: HashPool = job["hasher"]
+    # the counters of every directory from path down to the one whose files are being copied
+    records: list = [dir_record()]
+    pending: deque = deque()
+    for step in walk_steps(job, path, destination):
+        pending.append(step)
+        # the walk runs ahead while the oldest step is still being hashed and the pool has room for more
+        while len(pending) > 0:
+            if len(pending) < walk_lookahead and pending[0][0] == "files" and hasher.waiting(pending[0][1]) and not hasher.busy():
+                break
+            backup_step(job, records, *pending.popleft())
+    while len(pending) > 0:
+        backup_step(job, records, *pending.popleft())
+    return records[0]
+
+def backup_step(job: dict, records: list, kind: str, item, destination: str):
+    copier = job["copier"]
+    if kind == "enter":
+        logger.debug(item.path + " is a directory, descending")
+        copier.begin_dir(destination)
+        records.append(dir_record())
+        return
+    if kind == "leave":
+        prev: dict = records.pop()
+        backup_record: dict = records[-1]
+        # decided from the counters, so the destination never has to be listed again
+        keep: bool = job["type"] == 0 or prev["total_files"] + prev["total_directories"] > 0
+        copier.end_dir(item.path, destination, keep)
+        if not keep: #delete the directory if nothing was backed up
+            logger.debug("Nothing in %s needed to be backed up. Removing source directory" %item.path)
+        else:
+            backup_record["total_filesize"] += prev["total_filesize"]
+            backup_record["total_files"] += prev["total_files"]
+            backup_record["total_directories"] += prev["total_directories"] + 1
+            backup_record["linked_files"] += prev["linked_files"]
+            backup_record["linked_filesize"] += prev["linked_filesize"]
+        return
+
+    backup_record: dict = records[-1]
+    for entry, record, compare, rehashed in job["hasher"].results(item):
+        # checked before the checkpoint takes the current stat
+        finished: bool = finished_before(job, entry)
+        changed: bool = update_records(job, entry, record, compare, rehashed)
+        if not changed:
+            metrics.count("unchanged")
+        if finished and (job["type"] == 0 or changed or copier.can_link()) and copier.resume(entry.path, destination + "/" + entry.name, entry.stat):
+            backup_record["total_files"] += 1
+            backup_record["total_filesize"] += entry.stat.st_size
+            metrics.count("resumed")
+            expect(job, entry, destination + "/" + entry.name, compare)
+        elif not changed and copier.can_link():
+            backup_record["total_files"] += 1
+            backup_record["linked_files"] += 1
+            backup_record["linked_filesize"] += entry.stat.st_size
+            copier.link(entry.path, destination + "/" + entry.name, entry.stat)
+            expect(job, entry, destination + "/" + entry.name, compare)
+        elif job["type"] == 0 or changed:
+            backup_record["total_files"] += 1
+            backup_record["total_filesize"] += entry.stat.st_size
+            store(job, entry, destination + "/" + entry.name)
+            expect(job, entry, destination + "/" + entry.name, compare)
+
+def backup_changed(job: dict, path: str, destination: str, changed: list, deleted):
     backup_record: dict = {}
     backup_record["total_filesize"]: int = 0
     backup_record["total_files"]: int = 0
     backup_record["total_directories"]: int = 0
-
-    for item in os.listdir():
-        if is_ignored(conf, item):
-            logger.info("Skipping item " + item)
+    backup_record["linked_files"]: int = 0
+    backup_record["linked_filesize"]: int = 0
+
+    hasher: HashPool = job["hasher"]
+    copier = job["copier"]
+    files: list = []
+    gone: set = set()
+    start: float = time.perf_counter()
+    for changed_path in changed:
+        rel: str = changed_path[len(path) + 1:]
+        if ignored_path(rel):
+            metrics.count("ignored")
             continue
-
-        logger.debug("Backing up item " + item)
-
-        item_path: str = os.path.abspath(path + "/" + item)
-        item_destination_path: str = os.path.abspath(destination + "/" + item)
-        if os.path.isdir(item_path):
-            logger.debug(item + " is a directory, descending")
-            os.makedirs(item_destination_path)
-            prev: dict = backup_dir(full_backup, item_path, item_destination_path, records, use_md5)
-
-            if not full_backup and len(os.listdir(item_destination_path)) == 0: #delete the directory if nothing was backed up
-                logger.debug("Nothing in %s needed to be backed up. Removing source directory" %item_path)
-                os.rmdir(item_destination_path)
-            else:
-                backup_record["total_filesize"] += prev["total_filesize"]
-                backup_record["total_files"] += prev["total_files"]
-                backup_record["total_directories"] += prev["total_directories"] + 1
-
+        try:
+            st: os.stat_result = os.stat(changed_path)
+        except (FileNotFoundError, NotADirectoryError):
+            logger.debug("%s was removed since it changed" %changed_path)
+            # a removed directory takes the records of everything under it along, as a walk would find
+            removed: list = [changed_path] if job["records"].get(changed_path) is not None else []
+            removed += [record_path for record_path, record in job["records"].sorted_items(changed_path)]
+            for removed_path in removed:
+                if removed_path not in gone:
+                    gone.add(removed_path)
+                    deleted(removed_path)
+            continue
+        # directories only show up when something in them changed, and those paths are journaled too
+        if not stat.S_ISDIR(st.st_mode):
+            files.append(Entry(changed_path, os.path.basename(changed_path), rel, False, st))
+    metrics.add("scan", time.perf_counter() - start, len(files))
+
+    logger.debug("Checking %d journaled files in %s using %s" %(len(files), path, hasher.algorithm))
+    made: dict = {}
+    for entry, record, compare, rehashed in hasher.check(files, job["records"], job["cache"]):
+        finished: bool = finished_before(job, entry)
+        if not update_records(job, entry, record, compare, rehashed):
+            metrics.count("unchanged")
+            continue
+        # create the directories above the file the first time one of them is needed, parents first
+        parts: list = entry.rel.split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            directory: str = "/".join(parts[:i])
+            if directory not in made:
+                copier.begin_dir(destination + "/" + directory)
+                made[directory] = True
+        backup_record["total_files"] += 1
+        backup_record["total_filesize"] += entry.stat.st_size
+        if finished and copier.resume(entry.path, destination + "/" + entry.rel, entry.stat):
+            metrics.count("resumed")
         else:
-            if use_md5:
-                logger.debug("Checking file %s using MD5" %item_path)
-                compare: str = hashlib.md5(open(item_path, "rb").read()).hexdigest()
-            else:
-                logger.debug("Checking file %s using mtime" %item_path)
-                compare: str = str(os.path.getmtime(item_path))
-            if full_backup or (item_path not in records.keys() or records[item_path] != compare):
-                if full_backup:
-                    records[item_path] = compare
-                    logger.debug("Updated %s in records: %s" %(item_path, compare))
+            store(job, entry, destination + "/" + entry.rel)
+        expect(job, entry, destination + "/" + entry.rel, compare)
 
-                copy(item_path, item_destination_path)
-                logger.info("Backed up " + item_path)
-
-                backup_record["total_files"] += 1
-                backup_record["total_filesize"] += os.stat(item_path).st_size
-
-    os.chdir(previous_path)
+    # deepest first, like the walk closes them
+    for directory in reversed(list(made.keys())):
+        copier.end_dir(path + "/" + directory, destination + "/" + directory, True)
+    backup_record["total_directories"] += len(made)
     return backup_record
 
-def insert_old(backup_list: list, item: list):
-    if len(backup_list) == 0:
-        backup_list.append(item)
+def catalog_path(conf: dict):
+    return conf["destination"] + "catalog.toml"
+
+def destination_conf(conf: dict, destination: str):
+    # the settings as one destination sees them, for everything that works on a single destination
+    view: dict = dict(conf)
+    view.update(conf["destination-options"].get(destination, {}))
+    view["destination"] = destination
+    return view
+
+def find_interrupted(conf: dict):
+    # a backup that never finished still has its checkpoint
+    interrupted: list = []
+    for destination in conf["destinations"]:
+        if not os.path.isdir(destination):
+            continue
+        for backup in os.listdir(destination):
+            if re.search(backup_name_pattern, backup) is not None and os.path.exists(destination + backup + "/checkpoint.db"):
+                interrupted.append(backup)
+    if len(interrupted) == 0:
+        return None
+    return max(interrupted, key=backup_timestamp)
+
+def find_checkpoint(conf: dict, name: str):
+    for destination in conf["destinations"]:
+        if os.path.exists(destination + name + "/checkpoint.db"):
+            return destination + name + "/checkpoint.db"
+    return None
+
+def backup_timestamp(name: str):
+    return datetime.datetime.strptime(name.split("_", 1)[1], "%m-%d-%Y_%a_%H-%M-%S").timestamp()
+
+def catalog_entry(conf: dict, name: str, manifest: dict):
+    entry: dict = dict(manifest)
+    entry["name"] = name
+    entry["timestamp"] = backup_timestamp(name)
+    archive: str = name + "/" + name + ".zip"
+    if os.path.exists(conf["destination"] + archive):
+        entry["archive"] = archive
+        entry["archive_size"] = os.stat(conf["destination"] + archive).st_size
+    if os.path.exists(conf["destination"] + name + "/index.jsonl.gz"):
+        entry["index"] = name + "/index.jsonl.gz"
+    if os.path.exists(conf["destination"] + name + "/deleted.txt"):
+        entry["deleted"] = name + "/deleted.txt"
+    if os.path.exists(conf["destination"] + name + "/deltas.txt"):
+        entry["deltas"] = name + "/deltas.txt"
+    if os.path.exists(conf["destination"] + name + "/contents.jsonl.gz"):
+        entry["contents"] = name + "/contents.jsonl.gz"
+    return entry
+
+def infer_parent(earlier: list, entry: dict):
+    # backups made before manifests or head records existed don't name their parent
+    if entry["type"] == "Full" or "parent" in entry.keys():
         return
-    for i in range(0, len(backup_list)):
-        if backup_list[i][1] > item[1]:
-            for x in range(i, len(backup_list)):
-                tmp = backup_list[x]
-                backup_list[x] = item
-                item = tmp
-            break
-    backup_list.append(item)
+    for previous in reversed(earlier):
+        if entry["type"] == "Incremental" or previous["type"] == "Full":
+            entry["parent"] = previous["name"]
+            return
+
+def rebuild_catalog(conf: dict):
+    logger.info("Rebuilding backup catalog from " + conf["destination"])
+    catalog: list = []
+    for backup in sorted(os.listdir(conf["destination"])):
+        match = re.search(backup_name_pattern, backup)
+        if match is None:
+            continue
+        if os.path.exists(conf["destination"] + backup + "/checkpoint.db"):
+            # an interrupted run, left for --resume; find_interrupted keeps track of those
+            logger.debug("Skipping interrupted backup: " + backup)
+            continue
+        manifest: dict = read_manifest(conf["destination"] + backup)
+        if manifest is None:
+            manifest = {"type": match.group(1), "created": match.group(2)}
+        catalog.append(catalog_entry(conf, backup, manifest))
+        logger.debug("Found backup: " + backup)
+    catalog.sort(key=lambda entry: entry["timestamp"])
+    for i in range(0, len(catalog)):
+        infer_parent(catalog[:i], catalog[i])
+    save_catalog(conf, catalog)
+    logger.info("Catalog rebuilt with %d backups" %len(catalog))
+    return catalog
+
+def load_catalog(conf: dict):
+    if not os.path.exists(catalog_path(conf)):
+        return rebuild_catalog(conf)
+    return toml.load(catalog_path(conf)).get("backups", [])
+
+def save_catalog(conf: dict, catalog: list):
+    # written next to the catalog and moved over it so an interrupted write never loses it
+    write_toml({"backups": catalog}, catalog_path(conf) + ".tmp")
+    os.replace(catalog_path(conf) + ".tmp", catalog_path(conf))
+
+def add_to_catalog(conf: dict, entry: dict):
+    catalog: list = load_catalog(conf)
+    catalog = [old for old in catalog if old["name"] != entry["name"]]
+    infer_parent(catalog, entry)
+    catalog.append(entry)
+    catalog.sort(key=lambda entry: entry["timestamp"])
+    save_catalog(conf, catalog)
+
+def remove_from_catalog(conf: dict, names: set):
+    catalog: list = [entry for entry in load_catalog(conf) if entry["name"] not in names]
+    save_catalog(conf, catalog)
+
+def repository_path(conf: dict):
+    return conf["destination"] + "chunks"
+
+def collect_garbage(conf: dict):
+    chunks_dir: str = repository_path(conf)
+    if not os.path.isdir(chunks_dir):
+        return
+    referenced: set = set()
+    for entry in load_catalog(conf):
+        if "index" in entry.keys():
+            for record in read_index(conf["destination"] + entry["index"]):
+                if not record["dir"]:
+                    referenced.update(record["chunks"])
+    removed: int = 0
+    freed: int = 0
+    for prefix in os.scandir(chunks_dir):
+        if not prefix.is_dir():
+            continue
+        for chunk in os.scandir(prefix.path):
+            # leftover .tmp files from an interrupted backup are never referenced either
+            if chunk.name not in referenced:
+                freed += chunk.stat().st_size
+                os.remove(chunk.path)
+                removed += 1
+    logger.info("Removed %d unreferenced chunks, freeing %s" %(removed, hr_size(freed)))
+
+def list_backups(conf: dict):
+    catalog: list = load_catalog(conf)
+    if len(catalog) == 0:
+        print("No backups in " + conf["destination"])
+        return
+    for entry in catalog:
+        size: str = hr_size(entry.get("total_filesize", 0))
+        if "archive_size" in entry.keys():
+            size += " (" + hr_size(entry["archive_size"]) + " compressed)"
+        line: str = "%-40s %-12s %8s files  %s" %(entry["name"], entry["type"], str(entry.get("total_files", "?")), size)
+        if "parent" in entry.keys():
+            line += "  <- " + entry["parent"]
+        print(line)
 
 def get_old_backups(conf: dict):
-    logger.debug("Finding old backups in destination")
-    fulls: int = 0
-    differentials: int = 0
-    for backup in os.listdir(conf["destination"]):
-        if bool(re.search(r"Differential_(\d{2}-){2}\d{4}_(Mon|Tue|Wed|Thu|Fri|Sat|Sun)_(\d{2}-){2}\d{2}", backup)):
-            differentials += 1
-        elif bool(re.search(r"Full_(\d{2}-){2}\d{4}_(Mon|Tue|Wed|Thu|Fri|Sat|Sun)_(\d{2}-){2}\d{2}", backup)):
-            fulls += 1
-    old_fulls: list = []
-    old_differentials: list = []
-    if fulls - conf["keep-full-backups"] > 0 or differentials - conf["keep-differential-backups"] > 0:
+    logger.debug("Finding old backups in catalog")
+    catalog: list = load_catalog(conf)
+    found: dict = {"Full": [], "Differential": [], "Incremental": []}
+    for entry in catalog:
+        found[entry["type"]].append(entry)
+
+    keep: set = set()
+    for kind, limit in (("Full", conf["keep-full-backups"]), ("Differential", conf["keep-differential-backups"]), ("Incremental", conf["keep-incremental-backups"])):
+        if limit > 0:
+            keep.update(entry["name"] for entry in found[kind][-limit:])
+
+    # never remove a backup that a kept one builds on. Repository backups list every file themselves, so they don't need their parents
+    by_name: dict = {entry["name"]: entry for entry in catalog}
+    for name in list(keep):
+        parent: str = by_name[name].get("parent")
+        while parent is not None and "index" not in by_name[name].keys() and parent in by_name.keys() and parent not in keep:
+            logger.debug("Keeping %s because %s depends on it" %(parent, name))
+            keep.add(parent)
+            name = parent
+            parent = by_name[name].get("parent")
+
+    old_fulls: list = [[entry["name"], entry["timestamp"]] for entry in found["Full"] if entry["name"] not in keep]
+    old_differentials: list = [[entry["name"], entry["timestamp"]] for entry in found["Differential"] if entry["name"] not in keep]
+    old_incrementals: list = [[entry["name"], entry["timestamp"]] for entry in found["Incremental"] if entry["name"] not in keep]
+    if len(old_fulls) + len(old_differentials) + len(old_incrementals) > 0:
         logger.debug("Old backups are present that need cleaning")
-        tmp_dt: datetime.datetime = datetime.datetime(2000, 1, 1)
-        for backup in os.listdir(conf["destination"]):
-            if bool(re.search(r"Differential_(\d{2}-){2}\d{4}_(Mon|Tue|Wed|Thu|Fri|Sat|Sun)_(\d{2}-){2}\d{2}", backup)):
-                time_str: str = re.search(r"\d{2}-\d{2}-\d{4}_(Mon|Tue|Wed|Thu|Fri|Sun|Sat)_\d{2}-\d{2}-\d{2}", backup).group(0)
-                if time_str != '':
-                    time: datetime.datetime = tmp_dt.strptime(time_str, "%m-%d-%Y_%a_%H-%M-%S")
-                    insert_old(old_differentials, [backup, time])
-                    logger.debug("Found old backup: " + backup)
-            elif bool(re.search(r"Full_(\d{2}-){2}\d{4}_(Mon|Tue|Wed|Thu|Fri|Sat|Sun)_(\d{2}-){2}\d{2}", backup)):
-                time_str: str = re.search(r"\d{2}-\d{2}-\d{4}_(Mon|Tue|Wed|Thu|Fri|Sun|Sat)_\d{2}-\d{2}-\d{2}", backup).group(0)
-                if time_str != '':
-                    time: datetime.datetime = tmp_dt.strptime(time_str, "%m-%d-%Y_%a_%H-%M-%S")
-                    insert_old(old_fulls, [backup, time])
-                    logger.debug("Found old backup: " + backup)
-        for i in range(0, conf["keep-full-backups"]):
-            if len(old_fulls) > 0:
-                old_fulls.pop()
-            else:
-                break
-        for i in range(0, conf["keep-differential-backups"]):
-            if len(old_differentials) > 0:
-                old_differentials.pop()
-            else:
-                break
-    return old_fulls, old_differentials
+    return old_fulls, old_differentials, old_incrementals
     
+def parse_time(value: str):
+    # a backup name, or just its timestamp part
+    match = re.search(r"\d{2}-\d{2}-\d{4}_(Mon|Tue|Wed|Thu|Fri|Sat|Sun)_\d{2}-\d{2}-\d{2}", value)
+    if match is not None:
+        return datetime.datetime.strptime(match.group(0), "%m-%d-%Y_%a_%H-%M-%S").timestamp()
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+def resolve_chain(conf: dict, at: float):
+    catalog: list = load_catalog(conf)
+    by_name: dict = {entry["name"]: entry for entry in catalog}
+    target: dict = None
+    for entry in catalog:
+        if entry["timestamp"] <= at:
+            target = entry
+    if target is None:
+        return []
+
+    # walk back through the parents to the full backup the target builds on; repository backups list every file themselves
+    chain: list = [target]
+    while chain[-1]["type"] != "Full" and "index" not in chain[-1].keys():
+        parent: str = chain[-1].get("parent")
+        if parent is None or parent not in by_name.keys():
+            raise FileNotFoundError("%s depends on %s, which is not in the catalog" %(chain[-1]["name"], parent))
+        chain.append(by_name[parent])
+    chain.reverse()
+    return chain
+
+def archive_name(conf: dict, path: str):
+    # accept original source paths as well as paths inside the backup
+    if os.path.isabs(path):
+        for source in conf["source-directories"]:
+            source = os.path.abspath(source)
+            if path == source or path.startswith(source + "/"):
+                return item_from_path(source + "/") + path[len(source):]
+    return path.strip("/")
+
+def backup_members(conf: dict, entry: dict):
+    if "index" in entry.keys():
+        for record in read_index(conf["destination"] + entry["index"]):
+            yield record["path"], record["dir"], record
+        return
+    if "archive" in entry.keys():
+        # only the central directory is read here; member data is read when it's restored
+        with ZipFile(conf["destination"] + entry["archive"]) as z:
+            for info in z.infolist():
+                yield info.filename.rstrip("/"), info.is_dir(), info
+        return
+    folder: str = conf["destination"] + entry["name"]
+    for root, dirs, files in os.walk(folder):
+        rel: str = os.path.relpath(root, folder)
+        if rel == ".":
+            # the manifest and log sit next to the backed up directories
+            for name in dirs:
+                yield name, True, None
+            continue
+        for name in dirs:
+            yield rel + "/" + name, True, None
+        for name in files:
+            yield rel + "/" + name, False, os.stat(root + "/" + name)
+
+def read_deltas(conf: dict, entry: dict):
+    if "deltas" not in entry.keys():
+        return set()
+    with open(conf["destination"] + entry["deltas"]) as f:
+        return set(line.rstrip("\n") for line in f)
+
+def zip_handle(archive: str, opened: list):
+    # ZipFile handles aren't shared between threads, so each worker opens its own
+    handles: dict = getattr(restore_handles, "handles", None)
+    if handles is None:
+        handles = {}
+        restore_handles.handles = handles
+    if archive not in handles.keys():
+        handles[archive] = ZipFile(archive)
+        opened.append(handles[archive])
+    return handles[archive]
+
+def open_stored(conf: dict, entry: dict, member, arcname: str, opened: list):
+    # a file as a zip or folder backup stored it
+    if "archive" in entry.keys():
+        return zip_handle(conf["destination"] + entry["archive"], opened).open(member if member is not None else arcname)
+    return open(conf["destination"] + entry["name"] + "/" + arcname, "rb")
+
+def read_delta(conf: dict, patch, arcname: str, bases: dict, opened: list):
+    # yields the file a delta was made from, in runs copied from the full backup it was made against and runs stored in the delta
+    if patch.readline() != delta_magic:
+        raise ValueError("%s is not a delta" %arcname)
+    header: dict = json.loads(patch.readline())
+    if header["base"] not in bases.keys():
+        raise FileNotFoundError("%s is a delta against %s, which is not in the catalog" %(arcname, header["base"]))
+    size: int = 0
+    with open_stored(conf, bases[header["base"]], None, arcname, opened) as base:
+        for offset, length in header["runs"]:
+            src = patch
+            if offset >= 0:
+                # runs mostly move forwards through the base, which is all a compressed member can seek cheaply
+                base.seek(offset)
+                src = base
+            while length > 0:
+                chunk: bytes = src.read(min(length, hash_chunk_size))
+                if len(chunk) == 0:
+                    raise EOFError("%s ends before its delta does" %("the base of " + arcname if offset >= 0 else arcname))
+                length -= len(chunk)
+                size += len(chunk)
+                yield chunk
+    # reading the delta to its end also checks its CRC in a zip
+    if len(patch.read(1)) > 0 or size != header["size"]:
+        raise ValueError("%s doesn't match its delta header" %arcname)
+
+def restore_member(conf: dict, entry: dict, member, arcname: str, target: str, opened: list, bases: dict=None, restored: list=None):
+    # bases is given when the member is a delta, to find the full backup it was made against. How big the file it
+    # restores to is only known once it's rebuilt, so that goes into restored
+    path: str = target + "/" + arcname
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if "index" in entry.keys():
+        with open(path, "wb") as dst:
+            for digest in member["chunks"]:
+                dst.write(read_chunk(repository_path(conf), digest))
+        os.chmod(path, member["mode"])
+        os.utime(path, ns=(member["mtime"], member["mtime"]))
+        return
+    if bases is not None:
+        size: int = 0
+        with open_stored(conf, entry, member, arcname, opened) as patch, open(path, "wb") as dst:
+            for chunk in read_delta(conf, patch, arcname, bases, opened):
+                dst.write(chunk)
+                size += len(chunk)
+        restored.append(size)
+        if "archive" not in entry.keys():
+            copystat(conf["destination"] + entry["name"] + "/" + arcname, path)
+            return
+    elif "archive" not in entry.keys():
+        kernel_copy(conf["destination"] + entry["name"] + "/" + arcname, path)
+        return
+    else:
+        with open_stored(conf, entry, member, arcname, opened) as src, open(path, "wb") as dst:
+            copyfileobj(src, dst, hash_chunk_size)
+    mode: int = (member.external_attr >> 16) & 0o7777
+    if mode != 0:
+        os.chmod(path, mode)
+    mtime: float = time.mktime(member.date_time + (0, 0, -1))
+    os.utime(path, (mtime, mtime))
+
+def restore(conf: dict, target: str, at: float, includes: list):
+    chain: list = resolve_chain(conf, at)
+    if len(chain) == 0:
+        logger.critical("No backup was made before the requested time")
+        return False
+    logger.info("Restoring from " + " -> ".join(entry["name"] for entry in chain))
+
+    filters: list = [archive_name(conf, path) for path in includes]
+    def wanted(arcname: str):
+        if len(filters) == 0:
+            return True
+        for prefix in filters:
+            if arcname == prefix or arcname.startswith(prefix + "/") or prefix.startswith(arcname + "/"):
+                return True
+        return False
+
+    # later backups in the chain override earlier ones, and drop the files deleted before they ran
+    plan: dict = {}
+    for entry in chain:
+        if "deleted" in entry.keys():
+            with open(conf["destination"] + entry["deleted"]) as f:
+                for line in f:
+                    plan.pop(line.rstrip("\n"), None)
+        deltas: set = read_deltas(conf, entry)
+        for arcname, is_dir, member in backup_members(conf, entry):
+            if wanted(arcname):
+                plan[arcname] = (entry, is_dir, member, arcname in deltas)
+    bases: dict = {entry["name"]: entry for entry in load_catalog(conf)}
+
+    target = os.path.abspath(target)
+    start: float = time.monotonic()
+    files: int = 0
+    size: int = 0
+    restorer: CopyPool = CopyPool(conf["workers"])
+    opened: list = []
+    restored: list = []
+    for arcname, (entry, is_dir, member, delta) in plan.items():
+        if is_dir:
+            os.makedirs(target + "/" + arcname, exist_ok=True)
+            continue
+        files += 1
+        # a delta's stored size isn't the file's; restore_member counts those as it rebuilds them
+        if isinstance(member, dict):
+            size += member["size"]
+        elif not delta:
+            size += member.file_size if isinstance(member, ZipInfo) else member.st_size
+        restorer.run(restore_member, conf, entry, member, arcname, target, opened, bases if delta else None, restored)
+    restorer.join()
+    size += sum(restored)
+    for handle in opened:
+        handle.close()
+    restore_handles.handles = None
+    elapsed: float = max(time.monotonic() - start, 0.001)
+
+    logger.info("Restored %d files (%s) to %s in %.1fs: %s/s, %.0f files/s" %(files, hr_size(size), target, elapsed, hr_size(int(size / elapsed)), files / elapsed))
+    return True
+
+class VerifyReport:
+    def __init__(self):
+        self.lock: threading.Lock = threading.Lock()
+        self.files: int = 0
+        self.size: int = 0
+        self.corrupt: int = 0
+        self.missing: int = 0
+
+    def checked(self, name: str, arcname: str, size: int, problem: str):
+        with self.lock:
+            self.files += 1
+            self.size += size
+            if problem is not None:
+                self.corrupt += 1
+        if problem is not None:
+            logger.error("%s: %s is corrupt: %s" %(name, arcname, problem))
+
+    def lost(self, name: str, arcname: str):
+        with self.lock:
+            self.missing += 1
+        logger.error("%s: %s is missing" %(name, arcname))
+
+def verify_member(conf: dict, entry: dict, member, arcname: str, expected: dict, opened: list, checked_chunks: set, report: VerifyReport, bases: dict=None):
+    # reads the member back in chunks and checks it against what was recorded when it was backed up.
+    # Zip members check their own CRC when they're read to the end, and deltas are checked as the file they restore to
+    digest = hashlib.new(entry["hash_algorithm"]) if expected is not None and "hash" in expected.keys() else None
+    size: int = 0
+    problem: str = None
+    try:
+        if "index" in entry.keys():
+            recorded: int = member["size"]
+            for chunk_digest in member["chunks"]:
+                data: bytes = read_chunk(repository_path(conf), chunk_digest)
+                # chunks are named by their hash, and one shared by many files only needs checking once
+                if chunk_digest not in checked_chunks:
+                    if hashlib.blake2b(data, digest_size=32).hexdigest() != chunk_digest:
+                        raise ValueError("chunk %s doesn't match its hash" %chunk_digest)
+                    checked_chunks.add(chunk_digest)
+                size += len(data)
+                if digest is not None:
+                    digest.update(data)
+        elif bases is not None:
+            with open_stored(conf, entry, member, arcname, opened) as patch:
+                for chunk in read_delta(conf, patch, arcname, bases, opened):
+                    size += len(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+            recorded: int = size
+        else:
+            recorded: int = member.file_size if "archive" in entry.keys() else member.st_size
+            with open_stored(conf, entry, member, arcname, opened) as src:
+                while True:
+                    chunk: bytes = src.read(hash_chunk_size)
+                    if len(chunk) == 0:
+                        break
+                    size += len(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+        if size != recorded:
+            problem = "read back %d bytes, but %d were stored" %(size, recorded)
+        elif expected is not None and size != expected["size"]:
+            problem = "%d bytes, but the source file had %d when it was backed up" %(size, expected["size"])
+        elif digest is not None and digest.hexdigest() != expected["hash"]:
+            problem = "contents don't match the %s hash taken when it was backed up" %entry["hash_algorithm"]
+    # whatever stops a member from being read back means it can't be restored either
+    except Exception as e:
+        problem = "%s: %s" %(type(e).__name__, str(e))
+    report.checked(entry["name"], arcname, size, problem)
+
+def verify(conf: dict, names: list=None, destinations: list=None):
+    start: float = time.monotonic()
+    report: VerifyReport = VerifyReport()
+    backups: int = 0
+    opened: list = []
+    # every member of every chosen backup goes through one pool, so small backups don't leave it idle between them
+    verifier: CopyPool = CopyPool(conf["verify-workers"] if conf["verify-workers"] > 0 else (os.cpu_count() or 1))
+    for destination in destinations or conf["destinations"]:
+        if not os.path.isdir(destination):
+            logger.error("Destination %s is not available" %destination)
+            continue
+        view: dict = destination_conf(conf, destination)
+        checked_chunks: set = set()
+        catalog: list = load_catalog(view)
+        bases: dict = {entry["name"]: entry for entry in catalog}
+        for entry in catalog:
+            if names is not None and entry["name"] not in names:
+                continue
+            backups += 1
+            logger.info("Verifying %s in %s" %(entry["name"], destination))
+            # backups made before contents lists existed can only be checked against themselves
+            expected: dict = {}
+            if "contents" in entry.keys():
+                for record in read_index(destination + entry["contents"]):
+                    expected[record["path"]] = record
+            try:
+                deltas: set = read_deltas(view, entry)
+                for arcname, is_dir, member in backup_members(view, entry):
+                    if not is_dir:
+                        verifier.run(verify_member, view, entry, member, arcname, expected.pop(arcname, None), opened, checked_chunks, report, bases if arcname in deltas else None)
+            except Exception as e:
+                report.checked(entry["name"], entry.get("archive", entry.get("index", entry["name"])), 0, "%s: %s" %(type(e).__name__, str(e)))
+            for arcname in expected.keys():
+                report.lost(entry["name"], arcname)
+    verifier.join()
+    for handle in opened:
+        handle.close()
+    restore_handles.handles = None
+    elapsed: float = max(time.monotonic() - start, 0.001)
+
+    metrics.add("verify", elapsed, report.files, report.size)
+    metrics.count("corrupt", report.corrupt)
+    metrics.count("missing", report.missing)
+    logger.info("Verified %d files (%s) in %d backups in %.1fs: %s/s, %.0f files/s. %d corrupt, %d missing" %(report.files, hr_size(report.size), backups, elapsed, hr_size(int(report.size / elapsed)), report.files / elapsed, report.corrupt, report.missing))
+    if names is not None and backups == 0:
+        logger.error("No backup named " + ", ".join(names))
+        return False
+    return report.corrupt == 0 and report.missing == 0
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     
     # flags
     parser.add_argument('-f', '--full', help='Run a full backup', action='store_true')
     parser.add_argument('-d', '--differential', help='Run a differential backup', action='store_true')
+    parser.add_argument('-i', '--incremental', help='Run an incremental backup', action='store_true')
     parser.add_argument('--no-increment', help='Don\'t increase the number of differential backups run', action='store_true')
     parser.add_argument('--reset-increments', help='Reset the number of differential backups run to zero and exit', action='store_true')
     parser.add_argument('--no-compress', help='Don\'t zip the backup', action='store_true')
     parser.add_argument('-s', '--stats', help='Print statistics and exit', action='store_true')
+    parser.add_argument('-l', '--list', help='List the backups in the destination and exit', action='store_true')
+    parser.add_argument('--rebuild-catalog', help='Regenerate the backup catalog from the destination and exit', action='store_true')
+    parser.add_argument('--restore', help='Restore backed up files into TARGET and exit', type=str, metavar='TARGET')
+    parser.add_argument('--at', help='With --restore, restore the state as of this time (YYYY-MM-DD HH:MM:SS or a backup name). Defaults to the latest backup', type=str)
+    parser.add_argument('--include', help='With --restore, only restore this path. Can be given more than once', action='append', metavar='PATH')
+    parser.add_argument('--verify', help='Check that every file in BACKUP, or in all backups, reads back intact and matches what was backed up, and exit', nargs='?', const='', type=str, metavar='BACKUP')
+    parser.add_argument('--resume', help='Continue the most recent interrupted backup instead of starting a new one', action='store_true')
+    parser.add_argument('--rehash-all', help='Ignore cached hashes and rehash every file', action='store_true')
+    parser.add_argument('--explain-ignore', help='Show which ignore pattern, if any, skips PATH and exit', type=str, metavar='PATH')
+    parser.add_argument('-j', '--jobs', help='Number of files to copy concurrently (overrides workers in the config)', type=int)
+    parser.add_argument('--watch', help='Keep a journal of changed paths in the source directories for the journal config option. Runs until stopped', action='store_true')
+    parser.add_argument('--profile', help='Run the backup under cProfile and save the stats to profile.pstats in the backup folder', action='store_true')
 
     # optional args
     parser.add_argument('-config-path', help='Custom path to config file', type=str)
@@ -457,6 +3288,8 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    if args.watch:
+        tmp_log_path = watch_log_path
     init_logger()
     logger.debug("Program started")
     if not os.path.exists(log_dir):
@@ -471,101 +3304,205 @@ if __name__ == "__main__":
         conf: dict = toml.load(conf_path)
         if not verify_conf(conf):
             exit(1)
+        ignore_matcher = IgnoreMatcher(conf["ignored"])
+        throttle = Throttle(conf["bandwidth-limit"], conf["iops-limit"])
+        if conf["low-priority"]:
+            lower_priority()
+        if args.explain_ignore is not None:
+            explain_ignore(conf, args.explain_ignore)
+            os.remove(tmp_log_path)
+            exit(0)
+        if args.watch:
+            succeeded: bool = watch(conf)
+            write_log()
+            exit(0 if succeeded else 1)
+        if args.jobs is not None:
+            if args.jobs < 1:
+                logger.critical("--jobs must be at least 1")
+                exit(1)
+            conf["workers"] = args.jobs
+        if conf["hardlink-snapshots"] and not args.no_compress:
+            logger.warning("hardlink-snapshots only applies to --no-compress backups")
 
         if not os.path.exists(stats_path):
             stats: dict = gen_stats_file(stats_path)
         else:
             stats: dict = toml.load(stats_path)
+            stats.setdefault("incr_backups", 0)
+            stats.setdefault("last-incr-timestamp", 0)
 
         if args.reset_increments:
             conf["current-differential-backups"] = 0
             logger.info("Reset current differential backups to zero")
-            write_toml(conf, conf_path)
+            written: dict = {key: value for key, value in conf.items() if key != "destinations"}
+            written["destination"] = conf["destinations"] if len(conf["destinations"]) > 1 else conf["destination"]
+            write_toml(written, conf_path)
             os.remove(tmp_log_path)
             exit(0)
 
+        if args.rebuild_catalog:
+            for destination in conf["destinations"]:
+                rebuild_catalog(destination_conf(conf, destination))
+            write_log()
+            exit(0)
+
+        if args.list:
+            for destination in conf["destinations"]:
+                if len(conf["destinations"]) > 1:
+                    print(destination + ":")
+                try:
+                    list_backups(destination_conf(conf, destination))
+                except OSError as e:
+                    print("Could not read the backups in %s: %s" %(destination, str(e)))
+            os.remove(tmp_log_path)
+            exit(0)
+
+        if args.restore is not None:
+            at: float = parse_time(args.at) if args.at is not None else datetime.datetime.now().timestamp()
+            succeeded: bool = restore(conf, args.restore, at, args.include or [])
+            write_log()
+            exit(0 if succeeded else 1)
+
+        if args.verify is not None:
+            succeeded: bool = verify(conf, [args.verify] if args.verify != "" else None)
+            write_log()
+            exit(0 if succeeded else 1)
+
         if args.stats:
             print_stats(stats, conf)
             exit(0)
 
-        if stats["last-full-timestamp"] == 0 or stats["current-differential-backups"] >= conf["differential-backups"]:
-            backup_type: int = 0
+        between: int = 3 if conf["incremental-backups"] else 1
+        compress: bool = not args.no_compress
+        interrupted: str = find_interrupted(conf)
+        if args.resume:
+            if interrupted is None:
+                logger.critical("No interrupted backup to resume in " + ", ".join(conf["destinations"]))
+                exit(1)
+            checkpoint: SqliteRecords = SqliteRecords(find_checkpoint(conf, interrupted))
+            backup_type: int = int(checkpoint.meta["type"])
+            compress = checkpoint.meta["compressed"] == "1"
+            checkpoint.close()
         else:
-            backup_type: int = 1
-        if not args.full and not args.differential:
-            if backup_type == 0:
-                response: bool = confirm("The next backup is set to be a full backup. Proceed?")
-                if not response:
-                    if confirm("Perform a differential backup instead?", default_yes=False, default_no=True):
-                        backup_type = 1
-                    else:
-                        exit(0)
-
+            if interrupted is not None:
+                logger.warning("%s was interrupted; run with --resume to continue it instead of starting over" %interrupted)
+            if stats["last-full-timestamp"] == 0 or stats["current-differential-backups"] >= conf["differential-backups"]:
+                backup_type: int = 0
             else:
-                response: bool = confirm("The next backup is set to be a differential backup. Proceed?")
-                if not response:
-                    if confirm("Perform a full backup instead?", default_yes=False, default_no=True):
-                        backup_type = 0
-                    else:
-                        exit(0)
-
-        if (backup_type == 0 and not args.differential) or args.full:
-            logger.info("Started full backup")
+                backup_type: int = between
+            if args.full:
+                backup_type = 0
+            elif args.differential:
+                backup_type = 1
+            elif args.incremental:
+                backup_type = 3
+            else:
+                if backup_type == 0:
+                    response: bool = confirm("The next backup is set to be a full backup. Proceed?")
+                    if not response:
+                        if confirm("Perform a %s backup instead?" %backup_types[between].lower(), default_yes=False, default_no=True):
+                            backup_type = between
+                        else:
+                            exit(0)
+
+                else:
+                    response: bool = confirm("The next backup is set to be a %s backup. Proceed?" %backup_types[between].lower())
+                    if not response:
+                        if confirm("Perform a full backup instead?", default_yes=False, default_no=True):
+                            backup_type = 0
+                        else:
+                            exit(0)
+
+        if backup_type != 0 and not records_exist(conf):
+            logger.critical("Record file not found; has a full backup been run yet?")
+            exit(1)
 
-            backup_record: dict = full_backup(conf, compress=not args.no_compress)
-            log_destination = backup_record["log_path"]
+        profiler = cProfile.Profile() if args.profile else None
+        if profiler is not None:
+            profiler.enable()
+        logger.info("Started %s backup" %backup_types[backup_type].lower())
+        backup_record: dict = run_backup(conf, backup_type, compress=compress, rehash_all=args.rehash_all, resume=interrupted if args.resume else None)
+        log_destination = backup_record["log_path"]
+        log_copies = [path + "/" + os.path.basename(log_destination) for path in backup_record["paths"][1:]]
 
-            now: datetime = datetime.datetime.now()
+        now: datetime = datetime.datetime.now()
 
+        if backup_type == 0:
             stats["current-differential-backups"] = 0
             logger.debug("Reset current-differential-backups")
+        elif not args.no_increment:
+            stats["current-differential-backups"] += 1
 
-            stats["total_uncompressed_filesize"] += backup_record["total_filesize"]
-            stats["total_files"] += backup_record["total_files"]
-            stats["total_dirs"] += backup_record["total_directories"]
+        stats["total_uncompressed_filesize"] += backup_record["total_filesize"]
+        stats["total_files"] += backup_record["total_files"]
+        stats["total_dirs"] += backup_record["total_directories"]
 
-            stats["last_backup_type"] = 0
+        stats["last_backup_type"] = backup_type
+        if backup_type == 0:
             stats["full_backups"] += 1
             stats["last-full-timestamp"] = now.timestamp()
-
-            logger.debug("Updated stats")
-
-        else:
-            if not os.path.exists(records_path):
-                logger.critical("Record file not found; has a full backup been run yet?")
-                exit(1)
-
-            backup_record: dict = differential_backup(conf, compress=not args.no_compress)
-            log_destination = backup_record["log_path"]
-
-            if not args.no_increment:
-                stats["current-differential-backups"] += 1
-
-            now: datetime = datetime.datetime.now()
-
-            stats["total_uncompressed_filesize"] += backup_record["total_filesize"]
-            stats["total_files"] += backup_record["total_files"]
-            stats["total_dirs"] += backup_record["total_directories"]
-
-            stats["last_backup_type"] = 1
+        elif backup_type == 1:
             stats["diff_backups"] += 1
-            stats["current-differential-backups"]
             stats["last-diff-timestamp"] = now.timestamp()
-
-        logger.info("Scanning for old backups")
-        old_fulls, old_differentials = get_old_backups(conf)
-        if len(old_fulls) > 0 or len(old_differentials) > 0:
-            if confirm("There are %d old full backups and %d old differential backups. Clean?" %(len(old_fulls), len(old_differentials))):
-                if len(old_fulls) > 0:
-                    for backup in old_fulls:
-                        rmtree(conf["destination"] + backup[0])
-                        logger.info("Removed old backup: " + backup[0])
-                if len(old_differentials) > 0:
-                    for backup in old_differentials:
-                        rmtree(conf["destination"] + backup[0])
-                        logger.info("Removed old backup: " + backup[0])
         else:
-            logger.info("No old backups found")
+            stats["incr_backups"] += 1
+            stats["last-incr-timestamp"] = now.timestamp()
+        logger.debug("Updated stats")
+
+        verified: bool = True
+        if conf["verify-after-backup"]:
+            completed: list = [destination for destination in conf["destinations"] if os.path.abspath(destination + backup_record["name"]) in backup_record["paths"]]
+            verified = verify(conf, [backup_record["name"]], completed)
+            if not verified:
+                logger.error("%s failed verification; keeping all old backups" %backup_record["name"])
+
+        # every destination keeps its own catalog, so retention runs on each; one that can't be cleaned doesn't stop the others
+        for destination in conf["destinations"] if verified else []:
+            if not os.path.isdir(destination):
+                continue
+            view: dict = destination_conf(conf, destination)
+            logger.info("Scanning for old backups in " + destination)
+            try:
+                start: float = time.perf_counter()
+                old_fulls, old_differentials, old_incrementals = get_old_backups(view)
+                metrics.add("retention", time.perf_counter() - start)
+                if len(old_fulls) > 0 or len(old_differentials) > 0 or len(old_incrementals) > 0:
+                    where: str = " in " + destination if len(conf["destinations"]) > 1 else ""
+                    if confirm("There are %d old full backups, %d old differential backups and %d old incremental backups%s. Clean?" %(len(old_fulls), len(old_differentials), len(old_incrementals), where)):
+                        start = time.perf_counter()
+                        removed: set = set()
+                        for backup in old_fulls + old_differentials + old_incrementals:
+                            rmtree(destination + backup[0])
+                            removed.add(backup[0])
+                            logger.info("Removed old backup: " + backup[0])
+                        remove_from_catalog(view, removed)
+                        if conf["repository"]:
+                            collect_garbage(view)
+                        metrics.add("retention", time.perf_counter() - start, len(removed))
+                else:
+                    logger.info("No old backups found")
+            except OSError as e:
+                logger.error("Could not remove old backups from %s: %s" %(destination, str(e)))
+
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(backup_record["path"] + "/profile.pstats")
+            logger.info("Wrote profile to %s/profile.pstats" %backup_record["path"])
+        report: dict = metrics.report(backup_record)
+        for path in backup_record["paths"]:
+            try:
+                metrics.write_json(report, path + "/metrics.json")
+                logger.debug("Wrote metrics to %s/metrics.json" %path)
+            except OSError as e:
+                logger.error("Could not write metrics to %s: %s" %(path, str(e)))
+        if conf["metrics-textfile"] != "":
+            try:
+                metrics.write_prometheus(report, conf["metrics-textfile"])
+                logger.debug("Wrote metrics to " + conf["metrics-textfile"])
+            except OSError as e:
+                logger.error("Could not write metrics to %s: %s" %(conf["metrics-textfile"], str(e)))
         write_toml(stats, stats_path)
         logger.debug("Wrote stats file at " + stats_path)
         write_log()
+        if len(backup_record["failed"]) > 0 or not verified:
+            exit(1)
@@ -0,0 +1,262 @@
+from argparse import ArgumentParser
+import json
+import os
+import platform
+import random
+import re
+from shutil import rmtree, which
+import subprocess
+import sys
+import tempfile
+import time
+
+from backup import IgnoreMatcher
+
+backup_script: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backup.py")
+
+shapes: tuple = ("tiny", "huge", "deep", "ignored")
+modes: tuple = ("full", "differential", "md5", "no-compress")
+
+# metrics where a higher value is better; everything else is better lower
+higher_is_better: tuple = ("files_per_s", "mb_per_s", "scanned_files_per_s")
+
+def write_file(rng: random.Random, path: str, size: int):
+    # half random, half repeated so the archive step has something to compress
+    with open(path, "wb") as f:
+        remaining: int = size
+        while remaining > 0:
+            chunk: int = min(remaining, 1024 * 1024)
+            half: int = chunk // 2
+            f.write(rng.randbytes(half))
+            f.write(b"backup" * ((chunk - half) // 6) + b"b" * ((chunk - half) % 6))
+            remaining -= chunk
+
+def gen_tiny(rng: random.Random, root: str, scale: float):
+    files: int = max(1, int(100000 * scale))
+    per_dir: int = 1000
+    for i in range(0, files):
+        directory: str = "%s/d%04d" %(root, i // per_dir)
+        if i % per_dir == 0:
+            os.makedirs(directory)
+        write_file(rng, "%s/f%06d.txt" %(directory, i), rng.randint(0, 512))
+    return []
+
+def gen_huge(rng: random.Random, root: str, scale: float):
+    for i in range(0, 3):
+        write_file(rng, "%s/huge%d.bin" %(root, i), max(1, int(512 * 1024 * 1024 * scale)))
+    return []
+
+def gen_deep(rng: random.Random, root: str, scale: float):
+    depth: int = 64
+    chains: int = max(1, int(200 * scale))
+    for chain in range(0, chains):
+        path: str = "%s/c%04d" %(root, chain)
+        for level in range(0, depth):
+            path += "/l%02d" %level
+            os.makedirs(path)
+            write_file(rng, path + "/f.txt", rng.randint(0, 4096))
+    return []
+
+def gen_ignored(rng: random.Random, root: str, scale: float):
+    projects: int = max(1, int(100 * scale))
+    for project in range(0, projects):
+        base: str = "%s/p%04d" %(root, project)
+        os.makedirs(base + "/src")
+        for i in range(0, 20):
+            write_file(rng, "%s/src/m%02d.py" %(base, i), rng.randint(100, 8192))
+        # large build and cache trees that a real ignore list skips
+        for ignored in ("node_modules", "build", ".cache"):
+            for package in range(0, 10):
+                os.makedirs("%s/%s/pkg%02d" %(base, ignored, package))
+                for i in range(0, 20):
+                    write_file(rng, "%s/%s/pkg%02d/f%02d.js" %(base, ignored, package, i), rng.randint(100, 2048))
+    # a long list of patterns, most of which never match
+    patterns: list = ["unused_pattern_%03d$" %i for i in range(0, 200)]
+    patterns += ["node_modules", "build$", r"\.cache", r".*\.pyc$"]
+    return patterns
+
+generators: dict = {"tiny": gen_tiny, "huge": gen_huge, "deep": gen_deep, "ignored": gen_ignored}
+
+def modify_tree(rng: random.Random, root: str, fraction: float, ignored: list):
+    # only files the backup reads, so a differential of the ignored shape has something to back up
+    matcher: IgnoreMatcher = IgnoreMatcher(ignored)
+    paths: list = []
+    for path, dirs, names in os.walk(root):
+        rel: str = os.path.relpath(path, root)
+        prefix: str = "" if rel == "." else rel + "/"
+        dirs[:] = [name for name in dirs if not matcher.match(name, prefix + name)]
+        paths += [path + "/" + name for name in names if not matcher.match(name, prefix + name)]
+    paths.sort()
+    for path in rng.sample(paths, max(1, int(len(paths) * fraction))):
+        with open(path, "ab") as f:
+            f.write(rng.randbytes(64))
+
+def write_conf(workdir: str, source: str, ignored: list, algorithm: str, records_backend: str):
+    with open(workdir + "/conf.toml", "w") as f:
+        f.write("source-directories = [%s]\n" %json.dumps(source))
+        f.write("destination = %s\n" %json.dumps(workdir + "/destination/"))
+        f.write("ignored = [%s]\n" %", ".join(json.dumps(pattern) for pattern in ignored))
+        f.write("differential-backups = 6\nkeep-full-backups = 3\nkeep-differential-backups = 7\n")
+        f.write("hash-algorithm = %s\n" %json.dumps(algorithm))
+        f.write("records-backend = %s\n" %json.dumps(records_backend))
+    os.makedirs(workdir + "/destination", exist_ok=True)
+
+def parse_strace(path: str):
+    # the last line of strace -c is "100.00 <seconds> <usecs/call> <calls> <errors> total"
+    with open(path) as f:
+        for line in f:
+            if line.strip().endswith("total"):
+                numbers: list = re.findall(r"\d+(?:\.\d+)?", line)
+                return int(numbers[3])
+    return None
+
+def run_backup(workdir: str, flags: list, use_strace: bool):
+    command: list = [sys.executable, backup_script] + flags
+    trace: str = workdir + "/strace.txt"
+    if use_strace:
+        command = ["strace", "-f", "-c", "-o", trace] + command
+    start: float = time.monotonic()
+    process = subprocess.Popen(command, cwd=workdir, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    process.stdin.write(b"y\n" * 16)
+    process.stdin.close()
+    # wait4 reports the peak RSS of this child alone, including the hash worker processes it reaped
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed: float = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError("backup.py %s exited with %d" %(" ".join(flags), process.returncode))
+    syscalls = parse_strace(trace) if use_strace else None
+    return elapsed, usage.ru_maxrss, syscalls
+
+def run_metrics(workdir: str):
+    # the metrics.json of the newest backup, which is the run that was timed
+    folders: list = sorted(os.listdir(workdir + "/destination"), key=lambda name: os.stat(workdir + "/destination/" + name).st_mtime)
+    for name in reversed(folders):
+        if os.path.exists(workdir + "/destination/" + name + "/metrics.json"):
+            with open(workdir + "/destination/" + name + "/metrics.json") as f:
+                return json.load(f)
+    raise RuntimeError("backup.py wrote no metrics.json in " + workdir)
+
+def bench(shape: str, mode: str, source: str, ignored: list, seed: int, use_strace: bool, records_backend: str):
+    workdir: str = tempfile.mkdtemp(prefix="backup-bench-")
+    try:
+        algorithm: str = "md5" if mode == "md5" else "mtime"
+        write_conf(workdir, source, ignored, algorithm, records_backend)
+        if mode == "differential":
+            run_backup(workdir, ["-f"], False)
+            modify_tree(random.Random(seed + 1), source, 0.01, ignored)
+            elapsed, rss, syscalls = run_backup(workdir, ["-d"], use_strace)
+        elif mode == "no-compress":
+            elapsed, rss, syscalls = run_backup(workdir, ["-f", "--no-compress"], use_strace)
+        else:
+            elapsed, rss, syscalls = run_backup(workdir, ["-f"], use_strace)
+        metrics: dict = run_metrics(workdir)
+    finally:
+        rmtree(workdir)
+
+    # rates count what the run actually backed up; ignored files and unchanged files of a differential only show up as scanned
+    files: int = metrics["total_files"]
+    size: int = metrics["total_filesize"]
+    scanned: int = metrics["phases"].get("scan", {}).get("files", 0)
+    elapsed = max(elapsed, 0.000001)
+    return {
+        "shape": shape,
+        "mode": mode,
+        "records_backend": records_backend,
+        "files": files,
+        "bytes": size,
+        "scanned_files": scanned,
+        "seconds": round(elapsed, 4),
+        "files_per_s": round(files / elapsed, 2),
+        "mb_per_s": round(size / 1000000 / elapsed, 2),
+        "scanned_files_per_s": round(scanned / elapsed, 2),
+        "peak_rss_kb": rss,
+        "syscalls": syscalls,
+    }
+
+def run(args):
+    selected_shapes: list = args.shapes.split(",")
+    selected_modes: list = args.modes.split(",")
+    for name in selected_shapes:
+        if name not in shapes:
+            print("Unknown shape %s, must be one of %s" %(name, ", ".join(shapes)))
+            exit(1)
+    for name in selected_modes:
+        if name not in modes:
+            print("Unknown mode %s, must be one of %s" %(name, ", ".join(modes)))
+            exit(1)
+    use_strace: bool = args.strace
+    if use_strace and which("strace") is None:
+        print("strace not found; syscall counts will be left out")
+        use_strace = False
+
+    results: dict = {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(), "scale": args.scale, "seed": args.seed, "records_backend": args.records_backend},
+        "results": [],
+    }
+    for shape in selected_shapes:
+        for mode in selected_modes:
+            # every run gets a freshly generated tree so differential modifications don't leak into the next mode
+            tree: str = tempfile.mkdtemp(prefix="backup-bench-src-")
+            try:
+                source: str = tree + "/" + shape
+                os.makedirs(source)
+                ignored: list = generators[shape](random.Random(args.seed), source, args.scale)
+                result: dict = bench(shape, mode, source, ignored, args.seed, use_strace, args.records_backend)
+            finally:
+                rmtree(tree)
+            print("%-8s %-13s %8d of %8d files %10.1f files/s %8.2f MB/s %8d KB peak RSS" %(shape, mode, result["files"], result["scanned_files"], result["files_per_s"], result["mb_per_s"], result["peak_rss_kb"]))
+            results["results"].append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to " + args.output)
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline: dict = {(r["shape"], r["mode"]): r for r in json.load(f)["results"]}
+    with open(args.candidate) as f:
+        candidate: dict = {(r["shape"], r["mode"]): r for r in json.load(f)["results"]}
+
+    regressions: int = 0
+    for key in sorted(set(baseline.keys()) & set(candidate.keys())):
+        for metric in ("seconds", "files_per_s", "mb_per_s", "scanned_files_per_s", "peak_rss_kb", "syscalls"):
+            old = baseline[key].get(metric)
+            new = candidate[key].get(metric)
+            if old is None or new is None or old == 0:
+                continue
+            change: float = (new - old) / old * 100
+            worse: bool = change < -args.threshold if metric in higher_is_better else change > args.threshold
+            flag: str = "REGRESSION" if worse else ""
+            if worse:
+                regressions += 1
+            print("%-8s %-13s %-12s %14.2f -> %14.2f %+8.1f%% %s" %(key[0], key[1], metric, old, new, change, flag))
+    for key in sorted(set(baseline.keys()) ^ set(candidate.keys())):
+        print("%-8s %-13s only present in %s" %(key[0], key[1], "baseline" if key in baseline.keys() else "candidate"))
+
+    print("%d regressions over %.1f%%" %(regressions, args.threshold))
+    exit(1 if regressions > 0 else 0)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark backup.py against generated source trees")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Generate trees, run backups against them and write the results as JSON")
+    run_parser.add_argument('--shapes', help='Comma separated tree shapes: ' + ", ".join(shapes), type=str, default=",".join(shapes))
+    run_parser.add_argument('--modes', help='Comma separated backup modes: ' + ", ".join(modes), type=str, default=",".join(modes))
+    run_parser.add_argument('--scale', help='Multiplier for tree sizes; 1.0 is 100000 tiny files or three 512MB files', type=float, default=0.1)
+    run_parser.add_argument('--seed', help='Seed for the generated trees', type=int, default=0)
+    run_parser.add_argument('--records-backend', help='Records store the backups use', choices=("sqlite", "toml"), default="sqlite")
+    run_parser.add_argument('--strace', help='Count syscalls with strace -c (slows the runs down)', action='store_true')
+    run_parser.add_argument('-o', '--output', help='Path to write the results to', type=str, default="bench_results.json")
+
+    compare_parser = commands.add_parser("compare", help="Compare two result files and flag regressions")
+    compare_parser.add_argument('baseline', help='Results to compare against', type=str)
+    compare_parser.add_argument('candidate', help='Results to check', type=str)
+    compare_parser.add_argument('--threshold', help='Percentage change that counts as a regression', type=float, default=10.0)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
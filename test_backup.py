@@ -0,0 +1,196 @@
+import logging
+import os
+import random
+import tempfile
+import unittest
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+import backup
+
+backup.logger = logging.getLogger("backup-test")
+
+class TempDirTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory()
+        self.dir: str = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+class RecoverZipTest(TempDirTest):
+    def write_archive(self, path: str, members: dict):
+        with ZipFile(path, "w") as z:
+            for i, (name, data) in enumerate(members.items()):
+                z.writestr(name, data, ZIP_DEFLATED if i % 2 == 0 else ZIP_STORED)
+        # where each member's data ends, so the archive can be cut inside or after one
+        with ZipFile(path) as z:
+            return {info.filename: info.header_offset + len(info.FileHeader()) + info.compress_size for info in z.infolist()}
+
+    def test_truncated_archive_keeps_complete_members(self):
+        rng: random.Random = random.Random(1)
+        members: dict = {"a/%d.bin" %i: rng.randbytes(rng.randint(0, 50000)) for i in range(0, 6)}
+        path: str = self.dir + "/backup.zip"
+        ends: dict = self.write_archive(path, members)
+        # cut halfway through the fifth member, after the central directory is gone
+        cut: int = (ends["a/3.bin"] + ends["a/4.bin"]) // 2
+        os.truncate(path, cut)
+
+        recovered, end = backup.recover_zip(path)
+        self.assertEqual(list(recovered.keys()), ["a/%d.bin" %i for i in range(0, 4)])
+        self.assertEqual(end, ends["a/3.bin"])
+
+    def test_resumed_archive_reads_back(self):
+        members: dict = {"a/%d.txt" %i: (b"line %d\n" %i) * 1000 for i in range(0, 4)}
+        path: str = self.dir + "/backup.zip"
+        ends: dict = self.write_archive(path, members)
+        os.truncate(path, ends["a/2.txt"] + 10)
+
+        archive: backup.ZipArchive = backup.ZipArchive(path, resume=True)
+        for name in ("a/0.txt", "a/1.txt", "a/2.txt"):
+            archive.keep(archive.recovered.pop(name))
+        with archive.zip.open("a/3.txt", "w") as dst:
+            dst.write(members["a/3.txt"])
+        archive.close()
+
+        with ZipFile(path) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual({info.filename: z.read(info) for info in z.infolist()}, members)
+
+    def test_archive_without_complete_members(self):
+        path: str = self.dir + "/backup.zip"
+        self.write_archive(path, {"big.bin": random.Random(2).randbytes(100000)})
+        os.truncate(path, 1000)
+        self.assertEqual(backup.recover_zip(path), ({}, 0))
+
+class ResumeTest(TempDirTest):
+    def job(self, checkpoint: backup.SqliteRecords):
+        return {"resuming": True, "cache": checkpoint}
+
+    def test_only_unchanged_files_are_finished(self):
+        path: str = self.dir + "/f.bin"
+        with open(path, "wb") as f:
+            f.write(b"x" * 100)
+        checkpoint: backup.SqliteRecords = backup.SqliteRecords(self.dir + "/checkpoint.db", "sha256")
+        checkpoint.put(path, {"hash": "old", "stat": backup.record_stat(os.stat(path))})
+        checkpoint.flush()
+        entry: backup.Entry = backup.Entry(path, "f.bin", "f.bin", False, os.stat(path))
+        self.assertTrue(backup.finished_before(self.job(checkpoint), entry))
+
+        # rewritten with the same size after the interrupted run recorded it
+        with open(path, "wb") as f:
+            f.write(b"y" * 100)
+        os.utime(path, ns=(0, 0))
+        entry = backup.Entry(path, "f.bin", "f.bin", False, os.stat(path))
+        self.assertFalse(backup.finished_before(self.job(checkpoint), entry))
+        self.assertFalse(backup.finished_before({"resuming": True, "cache": None}, entry))
+        checkpoint.close()
+
+class IgnoreMatcherTest(unittest.TestCase):
+    def test_backreferences(self):
+        matcher: backup.IgnoreMatcher = backup.IgnoreMatcher([r"(a)\1", r"(b)\1", r"x.*", r"y", r"dir/(c)\1"])
+        for name, rel in (("aa", "aa"), ("bb", "bb"), ("xz", "xz"), ("y", "y"), ("cc", "dir/cc")):
+            self.assertTrue(matcher.match(name, rel), name)
+            self.assertIsNotNone(matcher.explain(name, rel), name)
+        self.assertFalse(matcher.match("ab", "ab"))
+        self.assertFalse(matcher.match("cd", "dir/cd"))
+
+class DeltaTest(TempDirTest):
+    block_size: int = 4096
+
+    def setUp(self):
+        super().setUp()
+        self.conf: dict = {"destination": self.dir + "/"}
+        self.bases: dict = {"Full_1": {"name": "Full_1"}}
+        self.base: bytes = random.Random(3).randbytes(self.block_size * 16 + 100)
+        os.makedirs(self.dir + "/Full_1/data")
+        with open(self.dir + "/Full_1/data/f.bin", "wb") as f:
+            f.write(self.base)
+
+    def signature(self):
+        with open(self.dir + "/Full_1/data/f.bin", "rb") as f:
+            weak, strong = backup.block_signature(f, self.block_size)
+        return {"block_size": self.block_size, "weak": weak, "strong": strong}
+
+    def make(self, data: bytes, limit: int=1 << 30):
+        source: str = self.dir + "/source.bin"
+        with open(source, "wb") as f:
+            f.write(data)
+        return backup.make_delta(source, self.signature(), "Full_1", self.dir + "/f.delta", limit)
+
+    def read(self):
+        opened: list = []
+        with open(self.dir + "/f.delta", "rb") as patch:
+            return b"".join(backup.read_delta(self.conf, patch, "data/f.bin", self.bases, opened))
+
+    def test_unchanged(self):
+        self.assertEqual(self.make(self.base), 0)
+        self.assertEqual(self.read(), self.base)
+
+    def test_rewritten_block(self):
+        data: bytearray = bytearray(self.base)
+        data[self.block_size * 5 + 10] ^= 0xff
+        self.assertEqual(self.make(bytes(data)), self.block_size)
+        self.assertEqual(self.read(), data)
+
+    def test_appended(self):
+        data: bytes = self.base[:self.block_size * 16] + random.Random(4).randbytes(self.block_size * 2 + 7)
+        self.assertEqual(self.make(data), self.block_size * 2 + 7)
+        self.assertEqual(self.read(), data)
+
+    def test_moved_blocks(self):
+        b: int = self.block_size
+        data: bytes = self.base[b * 8:b * 16] + self.base[:b * 8]
+        self.assertEqual(self.make(data), 0)
+        self.assertEqual(self.read(), data)
+
+    def test_over_limit(self):
+        data: bytes = random.Random(5).randbytes(self.block_size * 4)
+        self.assertIsNone(self.make(data, self.block_size * 2))
+        self.assertFalse(os.path.exists(self.dir + "/f.delta"))
+
+    def test_truncated_delta(self):
+        self.make(self.base[:self.block_size * 4] + random.Random(6).randbytes(self.block_size * 2))
+        os.truncate(self.dir + "/f.delta", os.path.getsize(self.dir + "/f.delta") - 10)
+        with self.assertRaises(EOFError):
+            self.read()
+
+    def test_changed_base(self):
+        self.make(self.base[:self.block_size * 4])
+        with open(self.dir + "/Full_1/data/f.bin", "wb") as f:
+            f.write(self.base[:self.block_size * 2])
+        with self.assertRaises(EOFError):
+            self.read()
+
+class ChunkTest(unittest.TestCase):
+    def chunks(self, data: bytes):
+        # cut the way store_chunks does, a buffer of at most chunk_max_size at a time
+        sizes: list = []
+        rest: bytearray = bytearray(data)
+        while len(rest) > 0:
+            end: int = backup.find_chunk_end(rest[:backup.chunk_max_size])
+            sizes.append(end)
+            del rest[:end]
+        return sizes
+
+    def test_sizes_in_bounds(self):
+        data: bytes = random.Random(7).randbytes(12 * 1024 * 1024)
+        sizes: list = self.chunks(data)
+        self.assertEqual(sum(sizes), len(data))
+        for size in sizes[:-1]:
+            self.assertGreaterEqual(size, backup.chunk_min_size)
+            self.assertLessEqual(size, backup.chunk_max_size)
+        self.assertEqual(self.chunks(b"abc"), [3])
+        self.assertEqual(self.chunks(bytes(backup.chunk_max_size * 2 + 1)), [backup.chunk_max_size] * 2 + [1])
+
+    def test_insert_moves_only_nearby_boundaries(self):
+        data: bytes = random.Random(8).randbytes(12 * 1024 * 1024)
+        before: list = self.chunks(data)
+        edited: bytes = data[:1000] + b"inserted" + data[1000:]
+        after: list = self.chunks(edited)
+        self.assertGreater(len(before), 4)
+        # everything past the first chunk is cut at the same place, just 8 bytes later
+        self.assertEqual(after[0], before[0] + 8)
+        self.assertEqual(after[1:], before[1:])
+
+if __name__ == "__main__":
+    unittest.main()